@@ -16,6 +16,19 @@ from graphlearn import LSGG
 
     
 
+class CoreVecCIP(cip.CoreInterfacePair):
+    def freeze(self):
+        return FrozenCoreVecCIP(self)
+
+
+class FrozenCoreVecCIP(cip.FrozenCIP):
+    __slots__ = ('core_vec',)
+
+    def __init__(self, cip_):
+        super(FrozenCoreVecCIP, self).__init__(cip_)
+        object.__setattr__(self, 'core_vec', cip_.core_vec)
+
+
 class LsggCoreVec(LSGG):
 
     '''  attaches a vector for each CIP, representing the nodes contained,,, 
@@ -40,17 +53,24 @@ class LsggCoreVec(LSGG):
         core_ids = [i for i,n in enumerate(graph.nodes()) if n in c_set] 
         return node_vectors[core_ids,:].sum(axis=0)
 
-    def _get_cips(self, graph, filter = lambda x:x):
+    def _get_cip(self, core=None, graph=None, context=None):
+        return CoreVecCIP(core=core, graph=graph, thickness=self.thickness, context=context)
+
+    def _get_cips(self, graph, filter = lambda x:x, keep=None):
         exgraph = cip._edge_to_vertex(graph)
         matrix = vertex_vec(exgraph, self.core_vec_decomposer) 
-        for core in self._get_cores(graph):
-            x = self._get_cip(core=core, graph=graph)
+        context = self._get_context(graph)
+        for core in self._get_cores(graph, context):
+            if keep is not None and not self._kept(core, graph, context, keep):
+                continue
+            x = self._get_cip(core=core, graph=graph, context=context)
             if x and filter(x.graph):
                 x.core_vec  = self.make_core_vector(x.graph, exgraph, matrix)
                 yield x
     
     def neighbors(self, graph, selectordata, filter = lambda x:True):
         """iterator over all neighbors of graph (that are conceiveable by the grammar)"""
+        self._check_hash_scheme()
         current_cips = self._get_cips(graph,filter)
         current_cips_congrus = [(current_cip,concip) for current_cip in current_cips 
                 for concip in self._get_congruent_cips(current_cip)   ]
@@ -2,15 +2,31 @@
 
 """Provides the graph grammar class."""
 
-from collections import defaultdict
+from collections import defaultdict, Counter
+from collections.abc import MutableMapping
+import copy
+import functools
+import time
 from graphlearn import lsgg_core_interface_pair
+from graphlearn.util.stats import GrammarStats
 import logging
 
 logger = logging.getLogger(__name__)
-from graphlearn.util.multi import mpmap
+from graphlearn.util.multi import WorkerPool, chunks
 
 
 class LocalSubstitutionGraphGrammarCore(object):
+    # a GrammarStats while stats are collected, see collect_stats
+    stats = None
+    # lsgg_core_interface_pair.hash_scheme() of the productions, grammars
+    # pickled before it was recorded have None, see _check_hash_scheme
+    hash_scheme = None
+    # unfiltered productions, kept by partial_fit. None: there are no raw
+    # counts (only fit was used, or the grammar was pickled before partial_fit existed)
+    raw_productions = None
+    # the interface hashes of the productions, None until _index_productions
+    # (grammars pickled before the index existed), see _has_interface
+    _interface_index = None
 
     def __init__(self,
                  radii=[0, 1],
@@ -35,6 +51,10 @@ class LocalSubstitutionGraphGrammarCore(object):
         self.filter_max_num_substitutions = filter_max_num_substitutions
 
         self.productions = defaultdict(dict)
+        self.raw_productions = None
+        self._interface_index = None
+        self.stats = None
+        self.hash_scheme = lsgg_core_interface_pair.hash_scheme()
         if nodelevel_radius_and_thickness:
             self._double_radius_and_thickness()
 
@@ -48,61 +68,245 @@ class LocalSubstitutionGraphGrammarCore(object):
     ###########
     # FITTING
     ##########
-    def fit(self, graphs):
+    def fit(self, graphs, twopass=False):
+        """
+        twopass: first only count the (interface, core) hashes, then build
+            the cips that survive the filters. graphs are read twice, so they
+            can not be a one-shot iterator.
+        """
+        self._check_writable()
+        self._start_hash_scheme()
+        self._detach_productions()
+        if twopass:
+            _check_reiterable(graphs)
+            keep = self._filter_counts(self._count_hashes(graphs))
+            self._store_graphs(graphs, keep)
+            self._index_productions()
+            return self
         self._store_graphs(graphs)
         self._filter_cips()
         return self
 
-    def _store_graphs(self, graphs):
+    def _store_graphs(self, graphs, keep=None):
         for graph in graphs:
-            self._store_graph(graph)
+            self._store_graph(graph, keep)
 
-    def _store_graph(self, graph):
-        for cip in self._get_cips(graph):
+    def _store_graph(self, graph, keep=None):
+        for cip in self._get_cips(graph, keep=keep):
             self._store_cip(cip)
 
-    def _get_cips(self, graph):
-        for core in self._get_cores(graph):
-            x = self._get_cip(core=core, graph=graph)
+    def _get_cips(self, graph, keep=None):
+        """
+        keep: {interface_hash: core_hashes}, if given only these cips are built
+        """
+        context = self._get_context(graph)
+        for core in self._get_cores(graph, context):
+            if keep is not None and not self._kept(core, graph, context, keep):
+                if self.stats is not None:
+                    self.stats.count('filtered_cores')
+                continue
+            x = self._cip(core, graph, context)
             if x:
                 yield x
 
-    def _get_cip(self, core=None, graph=None):
+    def _get_context(self, graph):
+        return lsgg_core_interface_pair.DecompositionContext(graph)
+
+    def _update_context(self, context, changed, removed):
+        """after an in place substitution, see DecompositionContext.update"""
+        # a core reaches max(radii)+1 from its root, its cip thickness further
+        context.update(changed, removed, max(self.radii) + 1 + self.thickness)
+
+    def _get_cip(self, core=None, graph=None, context=None):
+        # hashes that _applicable_cores or _kept computed are not computed again
         return lsgg_core_interface_pair.CoreInterfacePair(
             core=core,
             graph=graph,
-            thickness=self.thickness)
+            thickness=self.thickness,
+            context=context,
+            hashes=self._known_hashes(core, context))
+
+    def _get_cip_hashes(self, core=None, graph=None, context=None):
+        """(interface_hash, core_hash) of the cip _get_cip would make, None if there is none.
+        grammars that hash their cips differently have to overwrite
+        _get_interface_hash and _get_core_hash"""
+        interface_hash = self._get_interface_hash(core=core, graph=graph, context=context)
+        if interface_hash is None:
+            return None
+        return interface_hash, self._get_core_hash(core=core, graph=graph, context=context)
+
+    def _get_interface_hash(self, core=None, graph=None, context=None):
+        """the interface_hash of _get_cip_hashes, None if there is no cip"""
+        return lsgg_core_interface_pair.cip_interface_hash(core, self.thickness, context)
+
+    def _get_core_hash(self, core=None, graph=None, context=None):
+        """the core_hash of _get_cip_hashes"""
+        return lsgg_core_interface_pair.graph_hash(core)
+
+    def _kept(self, core, graph, context, keep):
+        interface_hash, core_hash = self._hashes(core, graph, context)
+        return interface_hash is not None and core_hash in keep.get(interface_hash, ())
+
+    def _hashes(self, core, graph, context, interface_only=False):
+        """
+        (interface_hash, core_hash) of _get_cip_hashes, kept in the context.
+        (None, None) if there is no cip, with interface_only the core hash
+        is not computed (None) if it is not known yet
+        """
+        key = frozenset(core.nodes())
+        hashes = context.hashes.get(key)
+        if hashes is None:
+            hashes = self._timed('hash', self._get_interface_hash, core=core, graph=graph, context=context), None
+        if hashes[0] is not None and hashes[1] is None and not interface_only:
+            hashes = hashes[0], self._timed('hash', self._get_core_hash, core=core, graph=graph, context=context)
+        context.hashes[key] = hashes
+        return hashes
+
+    def _known_hashes(self, core, context):
+        """both hashes of core if the context has them, else None"""
+        hashes = context.hashes.get(frozenset(core.nodes())) if context else None
+        return hashes if hashes and None not in hashes else None
+
+    def _count_hashes(self, graphs):
+        """{interface_hash: {core_hash: count}} of the cips of graphs"""
+        counts = defaultdict(Counter)
+        for graph in graphs:
+            context = self._get_context(graph)
+            for core in self._get_cores(graph, context):
+                hashes = self._timed('hash', self._get_cip_hashes, core=core, graph=graph, context=context)
+                if hashes is not None:
+                    counts[hashes[0]][hashes[1]] += 1
+        return counts
 
     def _store_cip(self, cip):
-        # setdefault is a fun function
-        self.productions[cip.interface_hash].setdefault(cip.core_hash, cip).count += 1
+        self._grammar_cip(cip).count += 1
+
+    def _grammar_cip(self, cip):
+        """the cip stored under the hashes of cip, a frozen copy of cip is stored if there is none"""
+        grammarcip = self.productions[cip.interface_hash].get(cip.core_hash)
+        if grammarcip is None:
+            grammarcip = self.productions[cip.interface_hash][cip.core_hash] = cip.freeze()
+            self._invalidate_index()
+        return grammarcip
+
+    def refilter(self, **filter_args):
+        """
+        apply the filters to the raw productions of partial_fit again.
+
+        filter_args: new values for filter_min_cip, filter_min_interface
+            and filter_max_num_substitutions
+        """
+        if self.raw_productions is None:
+            raise ValueError('refilter needs the raw productions of partial_fit')
+        for name, value in filter_args.items():
+            if name not in ('filter_min_cip', 'filter_min_interface', 'filter_max_num_substitutions'):
+                raise TypeError('refilter got an unexpected argument %s' % name)
+            setattr(self, name, value)
+        counts = {interface: {core: cip.count for core, cip in cips.items()}
+                  for interface, cips in self.raw_productions.items()}
+        keep = self._filter_counts(counts)
+        # the cips are shared with the raw productions
+        self.productions = defaultdict(dict)
+        for interface, cores in keep.items():
+            self.productions[interface] = {core: self.raw_productions[interface][core] for core in cores}
+        self._index_productions()
+        return self
+
+    def _detach_productions(self):
+        """after refilter the productions share their cips with the raw
+        productions, fit counts into copies so that the raw counts stay right"""
+        if self.raw_productions is not None:
+            self.productions = defaultdict(dict, {interface: {core: cip.copy() for core, cip in cips.items()}
+                                                  for interface, cips in self.productions.items()})
+
+    def _check_writable(self):
+        # the LazyProductions of a grammar file decode their interfaces on
+        # access, cips counted into them would be lost when they are evicted
+        if not isinstance(self.productions, MutableMapping):
+            raise ValueError('the productions of a grammar file are read only, fit a new grammar')
+
+    def _start_hash_scheme(self, productions=None):
+        """before cips are counted into productions (default: self.productions),
+        these have to be hashed as this version hashes"""
+        if len(self.productions if productions is None else productions):
+            self._check_hash_scheme()
+        self.hash_scheme = lsgg_core_interface_pair.hash_scheme()
+
+    def _check_hash_scheme(self):
+        if self.hash_scheme != lsgg_core_interface_pair.hash_scheme():
+            raise ValueError('the grammar was fitted with hash scheme %s, this version hashes with %s, '
+                             'refit required' % (self.hash_scheme, lsgg_core_interface_pair.hash_scheme()))
+
+    def _empty_copy(self):
+        """a copy without productions"""
+        grammar = copy.copy(self)
+        grammar.productions = defaultdict(dict)
+        grammar.raw_productions = None
+        grammar._interface_index = None
+        return grammar
 
     def _filter_cips(self):
-        self._filter_cips_by_counts()
-        if self.filter_max_num_substitutions is not None:
-            self._filter_cips_by_rank()
-        # remove interfaces with few substitutions
+        counts = {interface: {core: cip.count for core, cip in cips.items()}
+                  for interface, cips in self.productions.items()}
+        keep = self._filter_counts(counts)
         for interface in list(self.productions.keys()):
-            if len(self.productions[interface]) < self.filter_min_interface:
+            if interface not in keep:
                 self.productions.pop(interface)
-
-    def _filter_cips_by_counts(self):
-        for interface in list(self.productions.keys()):
+                continue
             for core in list(self.productions[interface].keys()):
-                if self.productions[interface][core].count < self.filter_min_cip:
+                if core not in keep[interface]:
                     self.productions[interface].pop(core)
+        self._index_productions()
 
-    def _filter_cips_by_rank(self):
-        for interface in list(self.productions.keys()):
-            cores = list(self.productions[interface].keys())
+    def _index_productions(self):
+        """remember the interface hashes of the productions, to quickly skip cores without production"""
+        self._interface_index = frozenset(self.productions.keys())
+
+    def _invalidate_index(self):
+        """the productions changed, the index is built again when it is used"""
+        self._interface_index = None
+
+    def _has_interface(self, interface_hash):
+        if self._interface_index is None:
+            self._index_productions()
+        return interface_hash in self._interface_index
+
+    def _filter_counts(self, counts):
+        """
+        counts: {interface_hash: {core_hash: count}}, filtered in place
+        returns counts
+        """
+        if self.stats is not None:
+            start = time.perf_counter()
+            n_interfaces, n_cips = len(counts), sum(map(len, counts.values()))
+        self._filter_cips_by_counts(counts)
+        if self.filter_max_num_substitutions is not None:
+            self._filter_cips_by_rank(counts)
+        # remove interfaces with few substitutions
+        for interface in list(counts.keys()):
+            if len(counts[interface]) < self.filter_min_interface:
+                counts.pop(interface)
+        if self.stats is not None:
+            self.stats.count('filtered_interfaces', n_interfaces - len(counts))
+            self.stats.count('filtered_cips', n_cips - sum(map(len, counts.values())))
+            self.stats.add_time('filter', time.perf_counter() - start)
+        return counts
+
+    def _filter_cips_by_counts(self, counts):
+        for interface in list(counts.keys()):
+            for core in list(counts[interface].keys()):
+                if counts[interface][core] < self.filter_min_cip:
+                    counts[interface].pop(core)
+
+    def _filter_cips_by_rank(self, counts):
+        for interface in list(counts.keys()):
+            cores = list(counts[interface].keys())
             if self.filter_max_num_substitutions < len(cores):
-                counts = [self.productions[interface][core].count for core in cores]
-                sorted_counts = sorted(counts, reverse=True)
+                sorted_counts = sorted(counts[interface].values(), reverse=True)
                 count_threshold = sorted_counts[self.filter_max_num_substitutions - 1]
-                for core in list(self.productions[interface].keys()):
-                    if self.productions[interface][core].count < count_threshold:
-                        self.productions[interface].pop(core)
-            cores = list(self.productions[interface].keys())
+                for core in cores:
+                    if counts[interface][core] < count_threshold:
+                        counts[interface].pop(core)
 
     ##############
     #  APPLYING A PRODUCTION
@@ -115,19 +319,90 @@ class LocalSubstitutionGraphGrammarCore(object):
         cips_ = [cip_ for cip_ in cips if cip_.core_hash != cip.core_hash]
         return cips_
 
+    def _applicable_cores(self, graph, context):
+        """
+        (root, radius) of the cores of graph whose interface has productions,
+        context.core(root, radius) is the core. cores that _get_cores does not
+        grow around a root (lsgg_ego) are given as they are.
+        the interface hash is computed for all cores, the core hash only for these
+        """
+        self._check_hash_scheme()
+        for core in self._get_cores(graph, context):
+            interface_hash = self._hashes(core, graph, context, interface_only=True)[0]
+            if interface_hash is not None and self._has_interface(interface_hash):
+                self._hashes(core, graph, context)
+                yield context.core_roots.get(frozenset(core.nodes()), core)
+            elif self.stats is not None:
+                self.stats.count('cores_without_productions')
+
     def _substitute_core(self, graph, cip, cip_):
         return lsgg_core_interface_pair.substitute_core(graph, cip, cip_)
 
     def neighbors(self, graph):
         """iterator over all neighbors of graph (that are conceiveable by the grammar)"""
         for cip in self._get_cips(graph):
-            for congruent_cip in self._get_congruent_cips(cip):
-                graph_ = self._substitute_core(graph, cip, congruent_cip)
+            for congruent_cip in self._congruent(cip):
+                graph_ = self._substitute(graph, cip, congruent_cip)
                 if graph_ is not None:
                     yield graph_
 
-    def _get_cores(self, graph):
-        return [core for core in lsgg_core_interface_pair.get_cores(graph, self.radii) if core]
+    def _get_cores(self, graph, context=None):
+        if self.stats is None:
+            return [core for core in lsgg_core_interface_pair.get_cores(graph, self.radii, context, self.thickness) if core]
+        start = time.perf_counter()
+        cores = [core for core in lsgg_core_interface_pair.get_cores(graph, self.radii, context, self.thickness) if core]
+        self.stats.add_time('decompose', time.perf_counter() - start)
+        self.stats.count('cores', len(cores))
+        return cores
+
+    ###########
+    # STATS
+    ###########
+    def collect_stats(self):
+        """count and time what the grammar does from now on (until self.stats = None), returns the GrammarStats.
+        the workers of a parallel fit count too, their stats are merged in"""
+        self.stats = GrammarStats()
+        return self.stats
+
+    def _timed(self, phase, func, *args, **kwargs):
+        if self.stats is None:
+            return func(*args, **kwargs)
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.stats.add_time(phase, time.perf_counter() - start)
+        return result
+
+    def _cip(self, core, graph, context=None):
+        """_get_cip, counted"""
+        if self.stats is None:
+            return self._get_cip(core=core, graph=graph, context=context)
+        start = time.perf_counter()
+        cip = self._get_cip(core=core, graph=graph, context=context)
+        self.stats.add_time('cip', time.perf_counter() - start, cip.interface_hash if cip else None)
+        return cip
+
+    def _congruent(self, cip):
+        """_get_congruent_cips, counted. the grammar has to hash as this version does"""
+        self._check_hash_scheme()
+        if self.stats is None:
+            return self._get_congruent_cips(cip)
+        start = time.perf_counter()
+        # a list, PiSi finds its congruent cips in a generator
+        cips = list(self._get_congruent_cips(cip))
+        self.stats.add_time('congruent', time.perf_counter() - start, cip.interface_hash)
+        self.stats.lookup(cip.interface_hash, len(cips))
+        return cips
+
+    def _substitute(self, graph, cip, cip_):
+        """_substitute_core, counted"""
+        if self.stats is None:
+            return self._substitute_core(graph, cip, cip_)
+        matches = lsgg_core_interface_pair.interface_match_counts
+        vf2, start = matches['vf2'], time.perf_counter()
+        graph_ = self._substitute_core(graph, cip, cip_)
+        self.stats.substitution(cip.interface_hash, time.perf_counter() - start, graph_ is not None,
+                                matches['vf2'] - vf2)
+        return graph_
 
     def __repr__(self):
         return "interfaces %d cores: %d " % \
@@ -136,14 +411,20 @@ class LocalSubstitutionGraphGrammarCore(object):
 
 class LocalSubstitutionGraphGrammar(LocalSubstitutionGraphGrammarCore):
 
-    def neighbors_core(self, graph, core):
+    def neighbors_core(self, graph, core, context=None):
         """iterator over all neighbors of graph (that are conceiveable by the grammar)"""
-        cip = self._get_cip(core, graph)
-        for congruent_cip in self._get_congruent_cips(cip):
-            graph_ = self._substitute_core(graph, cip, congruent_cip)
+        cip = self._cip(core, graph, context)
+        for congruent_cip in self._congruent(cip):
+            graph_ = self._substitute(graph, cip, congruent_cip)
             if graph_ is not None:
                 yield graph_
 
+    def applicable_cores(self, graphs):
+        """for each graph the (root, radius) of its cores whose interface has
+        productions in the grammar, root is a node of the expanded graph.
+        see _applicable_cores"""
+        return [list(self._applicable_cores(graph, self._get_context(graph))) for graph in graphs]
+
     def is_fit(self):
         return len(self.productions) > 0
 
@@ -183,17 +464,107 @@ class LocalSubstitutionGraphGrammar(LocalSubstitutionGraphGrammarCore):
         txt += '#production-rules: %5d' % n_productions
         return txt
 
-    def fit(self, graphs, n_jobs=1):
-        if n_jobs == 1:
-            return super(LocalSubstitutionGraphGrammar, self).fit(graphs)
-
-        # this provides parallelism
-        for ciplist in mpmap(self._make_cips_list, graphs, poolsize=n_jobs):
-            for cip in ciplist:
-                self._store_cip(cip)
-
+    def fit(self, graphs, n_jobs=1, batch_size=None, chunksize=10, twopass=False, pool=None):
+        """
+        graphs: any iterable, with n_jobs > 1 it is streamed through the
+            worker pool, batch_size graphs at a time.
+        chunksize: graphs per task. a worker counts the cips of its chunk in a
+            grammar of its own, the parent merges these partial grammars and
+            filters once all of them are in.
+        twopass: see LocalSubstitutionGraphGrammarCore.fit
+        pool: a WorkerPool to use instead of starting n_jobs workers
+        """
+        if n_jobs == 1 and pool is None:
+            return super(LocalSubstitutionGraphGrammar, self).fit(graphs, twopass=twopass)
+        self._check_writable()
+        self._start_hash_scheme()
+        self._detach_productions()
+        if twopass:
+            _check_reiterable(graphs)
+            keep = self._filter_counts(self._count_hashes_parallel(graphs, n_jobs, batch_size, chunksize, pool))
+            self._store_graphs_parallel(graphs, n_jobs, batch_size, chunksize, keep, pool)
+            self._index_productions()
+            return self
+        self._store_graphs_parallel(graphs, n_jobs, batch_size, chunksize, pool=pool)
         self._filter_cips()
         return self
 
-    def _make_cips_list(self, graph):
-        return list(self._get_cips(graph))
+    def partial_fit(self, graphs, n_jobs=1, batch_size=None, chunksize=10, pool=None):
+        """
+        add the cips of graphs to the raw productions, which are never
+        filtered, and derive the productions from them (see refilter).
+        arguments as in fit.
+        """
+        self._check_writable()
+        if self.raw_productions is None:
+            self.raw_productions = defaultdict(dict)
+        self._start_hash_scheme(self.raw_productions)
+        self.productions = self.raw_productions
+        if n_jobs == 1 and pool is None:
+            self._store_graphs(graphs)
+        else:
+            self._store_graphs_parallel(graphs, n_jobs, batch_size, chunksize, pool=pool)
+        return self.refilter()
+
+    def _count_hashes_parallel(self, graphs, n_jobs, batch_size, chunksize, pool=None):
+        counts = defaultdict(Counter)
+        for partial_counts in self._pmap('_count_hashes', graphs, n_jobs, batch_size, chunksize, pool):
+            for interface, cores in partial_counts.items():
+                counts[interface].update(cores)
+        return counts
+
+    def _store_graphs_parallel(self, graphs, n_jobs, batch_size, chunksize, keep=None, pool=None):
+        for productions in self._pmap('_make_productions', graphs, n_jobs, batch_size, chunksize, pool, keep=keep):
+            self._merge_productions(productions)
+
+    def _pmap(self, method, graphs, n_jobs, batch_size, chunksize, pool=None, **kwargs):
+        """method(chunk, **kwargs) of a grammar without productions, for all chunks of graphs.
+        the stats the workers collect are merged into self.stats"""
+        # the grammar without productions and the kwargs are resident in the
+        # workers, the tasks only carry graphs. a pool of n_jobs workers gets
+        # them when it starts, a given pool once per call
+        func = functools.partial(self._empty_copy()._call_counted, method, **kwargs)
+        buffersize = batch_size and max(1, batch_size // chunksize)
+        if pool is not None:
+            for result in self._merged_stats(pool.imap('func', chunks(graphs, chunksize), buffersize=buffersize,
+                                                       resident={'func': func})):
+                yield result
+            return
+        with WorkerPool(n_jobs, func=func) as pool:
+            for result in self._merged_stats(pool.imap('func', chunks(graphs, chunksize), buffersize=buffersize)):
+                yield result
+
+    def _merged_stats(self, results):
+        for result, stats in results:
+            if stats is not None:
+                self.stats.merge(stats)
+            yield result
+
+    def _call_counted(self, method, graphs, **kwargs):
+        """method(graphs, **kwargs) and the stats it collected, None if stats are not collected"""
+        if self.stats is not None:
+            self.stats = GrammarStats()
+        return getattr(self, method)(graphs, **kwargs), self.stats
+
+    def _make_productions(self, graphs, keep=None):
+        """the unfiltered productions of a few graphs, one frozen cip per (interface, core)"""
+        partial = self._empty_copy()
+        partial._store_graphs(graphs, keep)
+        return partial.productions
+
+    def _merge_productions(self, productions):
+        self._invalidate_index()
+        for cips in productions.values():
+            for cip in cips.values():
+                self._merge_cip(cip)
+
+    def _merge_cip(self, cip):
+        """add a frozen cip that was counted in another grammar"""
+        grammarcip = self.productions[cip.interface_hash].setdefault(cip.core_hash, cip)
+        if grammarcip is not cip:
+            grammarcip.count += cip.count
+
+
+def _check_reiterable(graphs):
+    if iter(graphs) is graphs:
+        raise ValueError('a twopass fit reads the graphs twice, they can not be an iterator')
@@ -1,42 +1,60 @@
 import eden.graph as eg
 from networkx.algorithms import isomorphism as iso
 import networkx as nx
+import numpy as np
 import logging
+from collections import Counter
+import copy
+import functools
+from graphlearn.util import graphhash
 
 from networkx.algorithms.shortest_paths.unweighted import _single_shortest_path_length as short_paths
 logger = logging.getLogger(__name__)
 
+# how substitute_core matched interfaces: 'canonical' or 'vf2' (the fallback)
+interface_match_counts = Counter()
+
+
+
+# hlabels are stable hashes of the labels, masked to this many bits (eden uses 20)
+HLABEL_BITS = 30
 
 
 def _add_hlabel(graph):
-    eg._label_preprocessing(graph)
+    # like eden's _label_preprocessing, but independent of PYTHONHASHSEED
+    for n, d in graph.nodes(data=True):
+        d['hlabel'] = _hlabel(d['label'])
+
+
+@functools.lru_cache(maxsize=2 ** 16)
+def _hlabel(label):
+    return (graphhash.stable_hash(label) & (2 ** HLABEL_BITS - 1)) + 1
+
 
 def _edge_to_vertex(graph):
     return eg._edge_to_vertex_transform(graph)
 
 
-def graph_hash(graph, get_node_label=lambda id, node: node['hlabel']):
+# 'numpy' or 'reference', see util.graphhash
+HASH_ENGINE = 'numpy'
+
+
+def graph_hash(graph, get_node_label=lambda id, node: node['hlabel'], engine=None):
     """
-    calculate a hash of a graph
+    calculate a hash of a graph, see graphhash.graph_hash
+    engine: 'numpy' or 'reference', defaults to HASH_ENGINE
     """
-    node_neighborhood_hashes = {n: _graph_hash_neighborhood(graph, n, get_node_label) for n in graph.nodes()}
+    return graphhash.graph_hash(graph, get_node_label=get_node_label, engine=engine or HASH_ENGINE)
 
-    edge_hash = lambda a, b: hash((min(a, b), max(a, b)))
-    l = [edge_hash(node_neighborhood_hashes[a],
-                   node_neighborhood_hashes[b]) for (a, b) in graph.edges()]
-    l.sort()
 
-    isolates = [n for (n, d) in graph.degree if d == 0]
-    z = [get_node_label(node_id, graph.nodes[node_id]) for node_id in isolates]
-    z.sort()
-    return hash(tuple(l + z))
+# the version of the hlabels, core and interface hashes, raise it when they change.
+# grammars remember the scheme they were fitted with and refuse to mix schemes
+HASH_VERSION = 1
 
 
-def _graph_hash_neighborhood(graph, node, get_node_label=lambda id, node: node['hlabel']):
-    d = nx.single_source_shortest_path_length(graph, node, 5)
-    l = [hash((get_node_label(nid, graph.nodes[nid]), dis)) for nid, dis in d.items()]
-    l.sort()
-    return hash(tuple(l))
+def hash_scheme():
+    """(HASH_VERSION, HASH_ENGINE), the hashes of different schemes do not match"""
+    return HASH_VERSION, HASH_ENGINE
 
 
 
@@ -47,6 +65,86 @@ def _graph_hash_neighborhood(graph, node, get_node_label=lambda id, node: node['
 #  decompose
 ###############
 
+class DecompositionContext:
+    """
+    everything about a graph that all of its cores and cips need.
+    built once per graph, so the expansion and the hlabels are computed once
+    and not once per cip.
+
+    PARAMS:
+    graph: a graph, expanded or not
+
+    ATTRIBUTES:
+    graph: the graph we were given
+    exgraph: expanded graph with hlabels, cips are subgraphs of this
+    roots: the nodes of the unexpanded graph (dict keys), cores are grown around them
+    core_dist: frozenset(core) -> (thickness, {node: distance to core}),
+        filled by get_cores so that cips need no bfs of their own
+    core_roots: frozenset(core) -> (root, radius) it was first reached from
+    hashes, cips: frozenset(core) -> what the grammar computed for the core
+    """
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.exgraph = _edge_to_vertex(graph)
+        _add_hlabel(self.exgraph)
+        self.roots = dict.fromkeys(n for n, d in self.exgraph.nodes(data=True) if 'edge' not in d)
+        self.core_dist = {}
+        self.core_roots = {}
+        self.hashes = {}
+        self.cips = {}
+        self._core_args = None
+        self._root_cores = {}
+
+    def core_distances(self, core, thickness):
+        """distances of all nodes within thickness of the core"""
+        thick, dist = self.core_dist.get(frozenset(core), (-1, None))
+        if thick == thickness:
+            return dist
+        if thick > thickness:
+            return {n: d for n, d in dist.items() if d <= thickness}
+        return {a: b for (a, b) in short_paths(self.exgraph, core, thickness)}
+
+    def root_cores(self, root, radii, thickness):
+        """[(radius, frozenset(core nodes), distances)] of root, see root_cores"""
+        if self._core_args != (tuple(radii), thickness):
+            self._core_args = (tuple(radii), thickness)
+            self._root_cores = {}
+            self.core_roots = {}
+        cores = self._root_cores.get(root)
+        if cores is None:
+            cores = self._root_cores[root] = [(radius, frozenset(nodes), dist) for radius, nodes, dist
+                                              in root_cores(self.exgraph, root, radii, thickness)]
+        return cores
+
+    def core(self, root, radius):
+        """the core of radius around root, with the radii and thickness of the last get_cores"""
+        if self._core_args is None:
+            raise ValueError('the cores of the context are not known yet, call get_cores first')
+        for r, key, dist in self.root_cores(root, *self._core_args):
+            if r == radius:
+                return self.exgraph.subgraph(key)
+        raise KeyError((root, radius))
+
+    def update(self, changed, removed, depth):
+        """
+        exgraph was changed in place: the removed nodes are gone, the changed
+        nodes are new or have new neighbors or attributes.
+        everything known about the roots within depth of a changed node is
+        forgotten, their cores are computed again when asked for.
+        """
+        affected = [n for n, d in short_paths(self.exgraph, [n for n in changed if n in self.exgraph], depth)]
+        for root in list(removed) + affected:
+            for radius, key, dist in self._root_cores.pop(root, ()):
+                self.core_dist.pop(key, None)
+                self.core_roots.pop(key, None)
+                self.hashes.pop(key, None)
+                self.cips.pop(key, None)
+        for node in removed:
+            self.roots.pop(node, None)
+        self.roots.update((n, None) for n in affected if 'edge' not in self.exgraph.nodes[n])
+
+
 class CoreInterfacePair:
     """
     this is referred to throughout the code as cip
@@ -57,6 +155,9 @@ class CoreInterfacePair:
     core: an 'expanded' subgraph of graph
     graph: an unexpanded graph
     thickness: absolute thickness on expanded Graph
+    context: DecompositionContext of graph, if given the expanded graph
+        is taken from there instead of being rebuilt
+    hashes: (interface_hash, core_hash) if they are known, see cip_hashes
 
 
     ATTRIBUTES:
@@ -73,32 +174,26 @@ class CoreInterfacePair:
     """
 
 
-    def __init__(self,core,graph,thickness):
+    def __init__(self,core,graph,thickness, context=None, hashes=None):
                      
             # preprocess, distances of core neighborhood, init counter
-            exgraph, dist = self.initialize_params(core,graph, thickness)
+            exgraph, dist = self.initialize_params(core,graph, thickness, context)
 
             # core and graph, no surprises there
-            self.core_hash = graph_hash(core)
+            self.core_hash = hashes[1] if hashes else graph_hash(core)
             self.core_nodes = list(core.nodes())
             self.graph = exgraph.subgraph([id for id, dst in dist.items() if dst <= thickness])
             # interface and hash are more tricky...
-            self.interface,  self.interface_hash  = self.make_interface(exgraph, dist, self.core_nodes,self.graph)
-
-
-    def make_interface(self, exgraph, dist, core_nodes, cipgraph):
-        # generate graph
-        interface = exgraph.subgraph([n for n,dst in dist.items() if dst > 0])
-
-        # adjust node-labels for matching and hashing...
-        for no in interface.nodes():
-            interface.nodes[no]['ilabel'] = interface.nodes[no]['hlabel'] + dist[no]
-            if dist[no] == 1 and 'edge' in interface.nodes[no] and \
-                    2==sum([cipgraph.has_edge(i,no) for i in core_nodes]):
+            self.interface,  self.interface_hash  = self.make_interface(exgraph, dist, self.core_nodes,self.graph,
+                                                                        hashes and hashes[0])
 
-                interface.nodes[no]['ilabel'] += 1337
 
-        return interface, self.interface_hash(interface)
+    def make_interface(self, exgraph, dist, core_nodes, cipgraph, interface_hash=None):
+        # a graph of its own (exgraph may be shared with other cips), the nodes
+        # only carry the ilabel that matching and hashing use
+        nodes = [n for n, dst in dist.items() if dst > 0]
+        interface = _interface_graph(exgraph, nodes, _interface_labels(exgraph, nodes, dist, core_nodes))
+        return interface, interface_hash if interface_hash is not None else self.interface_hash(interface)
 
     def interface_hash(self,interface):
         get_node_label = lambda id, node: node['ilabel']
@@ -106,12 +201,18 @@ class CoreInterfacePair:
         return interface_hash
 
 
-    def initialize_params(self, core, graph, thickness):
+    def initialize_params(self, core, graph, thickness, context=None):
         # preprocess, distances of core neighborhood, init counter
-        exgraph = _edge_to_vertex(graph)
-        _add_hlabel(exgraph)
-        _add_hlabel(core)
-        dist = {a: b for (a, b) in short_paths(exgraph, core.nodes(), thickness)}
+        if context is None:
+            exgraph = _edge_to_vertex(graph)
+            _add_hlabel(exgraph)
+            _add_hlabel(core)
+            dist = {a: b for (a, b) in short_paths(exgraph, core.nodes(), thickness)}
+        else:
+            exgraph = context.exgraph
+            if not all('hlabel' in d for n, d in core.nodes(data=True)):
+                _add_hlabel(core)
+            dist = context.core_distances(core.nodes(), thickness)
         self.count=0
         return exgraph, dist
 
@@ -128,15 +229,209 @@ class CoreInterfacePair:
                        self.core_hash, 
                        len(self.core_nodes))
 
+    def canonical(self):
+        """the interface nodes in canonical order and the canonical form, see canonical_interface"""
+        if not hasattr(self, '_canonical'):
+            self._canonical = canonical_interface(self.interface)
+        return self._canonical
+
+    def freeze(self):
+        """compact copy for storage in a grammar"""
+        return FrozenCIP(self)
+
+
+def _interface_labels(exgraph, nodes, dist, core_nodes):
+    """the distance dependent labels of the interface nodes"""
+    core_nodes = set(core_nodes)
+    ilabels = {}
+    for no in nodes:
+        ilabels[no] = exgraph.nodes[no]['hlabel'] + dist[no]
+        if dist[no] == 1 and 'edge' in exgraph.nodes[no] and \
+                2 == sum([i in core_nodes for i in exgraph.neighbors(no)]):
+            ilabels[no] += 1337
+    return ilabels
+
+
+def cip_hashes(core, thickness, context):
+    """
+    (interface_hash, core_hash) of the cip of core, as CoreInterfacePair
+    would compute them, but without building the cip graph and interface
+    """
+    return cip_interface_hash(core, thickness, context), graph_hash(core)
+
+
+def cip_interface_hash(core, thickness, context):
+    """the interface_hash of cip_hashes"""
+    if not all('hlabel' in d for n, d in core.nodes(data=True)):
+        _add_hlabel(core)
+    dist = context.core_distances(core.nodes(), thickness)
+    nodes = [n for n, dst in dist.items() if dst > 0]
+    interface = _interface_graph(context.exgraph, nodes, _interface_labels(context.exgraph, nodes, dist, core.nodes()))
+    return graph_hash(interface, get_node_label=lambda id, node: node['ilabel'])
+
+
+def _interface_graph(exgraph, nodes, ilabels):
+    """the subgraph of exgraph on nodes, with only the ilabels as node attributes"""
+    interface = nx.Graph(expanded=True)
+    interface.add_nodes_from((n, {'ilabel': ilabels[n]}) for n in nodes)
+    adj = exgraph._adj
+    interface.add_edges_from((a, b) for a in nodes for b in adj[a] if b in ilabels)
+    return interface
+
+
+class FrozenCIP(object):
+    """
+    how a cip is stored in the grammar.
+
+    a CoreInterfacePair refers to the graph it was cut from (graph and interface
+    are subgraphs), a FrozenCIP copies only the cip nodes (and their attributes)
+    and keeps the edges, the core and the interface as index arrays.
+    graph, interface and core_nodes are rebuilt from these on access.
+
+    all attributes except count are read only.
+    """
+
+    __slots__ = ('core_hash', 'interface_hash', 'count', 'nodes', 'node_attrs',
+                 'edges', 'core', 'interface_idx', 'ilabels', 'canonical_idx', 'canonical_form')
+    _mutable = ('count',)
+
+    def __init__(self, cip):
+        graph = cip.graph
+        nodes = list(graph.nodes())
+        index = {n: i for i, n in enumerate(nodes)}
+        interface_nodes = list(cip.interface.nodes())
+        init = lambda name, value: object.__setattr__(self, name, value)
+        init('core_hash', cip.core_hash)
+        init('interface_hash', cip.interface_hash)
+        init('count', cip.count)
+        init('nodes', np.array(nodes))
+        init('node_attrs', tuple(dict(d) for n, d in graph.nodes(data=True)))
+        init('edges', np.array([(index[a], index[b]) for a, b in graph.edges()], dtype=np.int32).reshape(-1, 2))
+        init('core', np.array([index[n] for n in cip.core_nodes], dtype=np.int32))
+        init('interface_idx', np.array([index[n] for n in interface_nodes], dtype=np.int32))
+        init('ilabels', np.array([cip.interface.nodes[n]['ilabel'] for n in interface_nodes], dtype=np.int64))
+        canonical_nodes, canonical_form = cip.canonical()
+        init('canonical_idx', np.array([index[n] for n in canonical_nodes], dtype=np.int32))
+        init('canonical_form', canonical_form)
+
+    def __setattr__(self, name, value):
+        if name not in self._mutable:
+            raise AttributeError("%s of a stored cip is read only" % name)
+        object.__setattr__(self, name, value)
+
+    def _slotnames(self):
+        return [name for cls in type(self).__mro__ for name in getattr(cls, '__slots__', ())]
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self._slotnames() if hasattr(self, name)}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
+
+    def freeze(self):
+        return self
+
+    def copy(self):
+        """a copy whose mutable attributes change independently of this one"""
+        cip = copy.copy(self)
+        for name in self._mutable:
+            if hasattr(self, name):
+                object.__setattr__(cip, name, copy.copy(getattr(self, name)))
+        return cip
+
+    @property
+    def core_nodes(self):
+        return self.nodes[self.core].tolist()
+
+    @property
+    def graph(self):
+        graph = nx.Graph(expanded=True)
+        graph.add_nodes_from(zip(self.nodes.tolist(), map(dict, self.node_attrs)))
+        graph.add_edges_from(self.nodes[self.edges].tolist(), label=None)
+        return graph
+
+    @property
+    def interface(self):
+        interface = nx.Graph(expanded=True)
+        interface.add_nodes_from((self.nodes[i].item(), dict(self.node_attrs[i], ilabel=ilabel))
+                                 for i, ilabel in zip(self.interface_idx.tolist(), self.ilabels.tolist()))
+        mask = np.isin(self.edges, self.interface_idx).all(axis=1)
+        interface.add_edges_from(self.nodes[self.edges[mask]].tolist(), label=None)
+        return interface
+
+    def canonical(self):
+        return self.nodes[self.canonical_idx].tolist(), self.canonical_form
+
+    ascii = CoreInterfacePair.ascii
+    __str__ = CoreInterfacePair.__str__
+
 #########
 # CORES
 #########
-def get_cores(graph, radii):
-    exgraph = _edge_to_vertex(graph)
-    for root in graph.nodes():
-        id_dst = {node: dis for (node, dis) in short_paths(exgraph, [root], max(radii)+1)}
-        for e in loopradii_makesubgraphs(exgraph, id_dst, radii):
-            yield e 
+def get_cores(graph, radii, context=None, thickness=0):
+    """
+    cores around every root, a node set that is reached from several roots/radii is produced once.
+    the (root, radius) it is produced for is kept in context.core_roots.
+
+    if thickness is given, the distances of the nodes around each core are
+    stored in the context, where the cips will find them.
+    """
+    if context is None:
+        context = DecompositionContext(graph)
+    exgraph = context.exgraph
+    seen = set()
+    for root in context.roots:
+        for radius, key, dist in context.root_cores(root, radii, thickness):
+            if key not in seen:
+                seen.add(key)
+                context.core_roots.setdefault(key, (root, radius))
+                if thickness:
+                    context.core_dist[key] = (thickness, dist)
+                yield exgraph.subgraph(key)
+
+
+def root_cores(exgraph, root, radii, thickness=0):
+    """
+    a single bfs from root, up to max(radii)+thickness, serves all radii.
+
+    yields (radius, core nodes, distance to core) for every radius, the
+    distances reach up to thickness (None if thickness is 0).
+    a node is in the core when dist <= r or it is linked to 2 nodes at distance r.
+    """
+    layers = [[]]
+    id_dst = {}
+    for node, dis in short_paths(exgraph, [root], max(radii) + max(thickness, 1)):
+        if dis == len(layers):
+            layers.append([])
+        layers[dis].append(node)
+        id_dst[node] = dis
+
+    # links to the previous layer, counted once for every node that can close a core
+    closing = {r + 1 for r in radii}
+    links = {node: sum(1 for n in exgraph.neighbors(node) if id_dst.get(n) == dis - 1)
+             for dis in closing if dis < len(layers) for node in layers[dis]}
+
+    ball = []
+    for r in sorted(radii):
+        while len(ball) < r + 1 and len(ball) < len(layers):
+            ball.append(layers[len(ball)])
+        closure = [n for n in layers[r + 1] if links[n] == 2] if r + 1 < len(layers) else []
+        nodes = [n for layer in ball for n in layer] + closure
+        if len(nodes) < len(exgraph):
+            yield r, nodes, _core_distances(exgraph, nodes, closure, id_dst, r, thickness)
+
+
+def _core_distances(exgraph, nodes, closure, id_dst, r, thickness):
+    if not thickness:
+        return None
+    # a closure node whose neighbors all lie within r is no shortcut, distances
+    # to the core are then just distances to the root minus r
+    if all(id_dst.get(n, r + 1) <= r for c in closure for n in exgraph.neighbors(c)):
+        dist = {n: d - r for n, d in id_dst.items() if r < d <= r + thickness}
+        dist.update((n, 0) for n in nodes)
+        return dist
+    return {a: b for (a, b) in short_paths(exgraph, nodes, thickness)}
 
 
 def loopradii_makesubgraphs(exgraph, id_dst, radii):
@@ -177,6 +472,37 @@ def get_cores_closeloop(graph, radii):
 # compose
 ######
 
+def canonical_interface(interface):
+    """
+    orders the interface nodes by the hash of their ilabel neighborhood,
+    see graphhash.canonical_order.
+
+    RETURNS: nodes in that order, form: the hashes, the ilabels and the edges
+    (as positions in the order). if two interfaces have the same form,
+    mapping their nodes by position is an isomorphism. isomorphic interfaces
+    usually have the same form, but that is not guaranteed.
+    """
+    nodes = list(interface.nodes())
+    order, keys = graphhash.canonical_order(interface, get_node_label=lambda id, node: node['ilabel'])
+    nodes = [nodes[i] for i in order]
+    position = {n: i for i, n in enumerate(nodes)}
+    ilabels = np.array([interface.nodes[n]['ilabel'] for n in nodes], dtype=np.int64)
+    edges = sorted(tuple(sorted((position[a], position[b]))) for a, b in interface.edges())
+    form = keys.tobytes() + ilabels.tobytes() + np.array(edges, dtype=np.int32).tobytes()
+    return nodes, form
+
+
+def _interface_map(cip, congruent_cip):
+    """maps the interface nodes of congruent_cip to those of cip, empty dict if there is no isomorphism"""
+    nodes, form = cip.canonical()
+    congruent_nodes, congruent_form = congruent_cip.canonical()
+    if form == congruent_form:
+        interface_match_counts['canonical'] += 1
+        return dict(zip(congruent_nodes, nodes))
+    interface_match_counts['vf2'] += 1
+    return next(find_all_isomorphisms(congruent_cip.interface, cip.interface), {})
+
+
 def find_all_isomorphisms(interface_graph, congruent_interface_graph):
     label_matcher = lambda x, y: x['ilabel'] == y['ilabel']  # and \ x.get('shard', 1) == y.get('shard', 1)
     return iso.GraphMatcher(interface_graph, congruent_interface_graph, node_match=label_matcher).match()
@@ -191,7 +517,7 @@ def substitute_core(graph, cip, congruent_cip):
 
     # relabel the nodes in the congruent cip such that the interface node-ids match with the graph and the
     # core ids dont overlap
-    interface_map = next(find_all_isomorphisms(congruent_cip.interface, cip.interface))
+    interface_map = _interface_map(cip, congruent_cip)
     if len(interface_map) != len(cip.interface):
         logger.log(10, "isomorphism failed, likely due to hash collision")
         return None
@@ -229,3 +555,102 @@ def substitute_core(graph, cip, congruent_cip):
 
     return ret
     '''
+
+
+class WorkingGraph(object):
+    """
+    an expanded graph that is changed in place by substitutions.
+
+    substitute() does what substitute_core does, without copying the graph,
+    and logs how to revert the change. undo() reverts the last substitution
+    in O(|cip|), commit() keeps all substitutions so far.
+    graph() materializes a standalone (unexpanded) networkx graph.
+
+    cips for substitute() have to be cut from exgraph, e.g. via
+    DecompositionContext(workinggraph.exgraph). undo restores node ids and
+    attributes, so such cips stay valid until a substitution is committed.
+    """
+
+    def __init__(self, graph):
+        exgraph = _edge_to_vertex(graph)
+        self.exgraph = exgraph.copy() if exgraph is graph else exgraph
+        _add_hlabel(self.exgraph)
+        self.next_id = max(self.exgraph.nodes()) + 1
+        self.log = []
+        self._graph = None
+
+    def substitute(self, cip, congruent_cip):
+        """replace the core of cip by the core of congruent_cip, False if the interfaces dont match"""
+        interface_map = _interface_map(cip, congruent_cip)
+        if len(interface_map) != len(cip.interface):
+            logger.log(10, "isomorphism failed, likely due to hash collision")
+            return False
+        exgraph = self.exgraph
+        entry = {'next_id': self.next_id, 'graph': self._graph,
+                 'removed_nodes': [(n, exgraph.nodes[n]) for n in cip.core_nodes],
+                 'removed_edges': list(exgraph.edges(cip.core_nodes, data=True)),
+                 'changed_nodes': [], 'changed_edges': [], 'added_edges': []}
+        exgraph.remove_nodes_from(cip.core_nodes)
+        self._graph = None
+
+        core_rename = {c: i + self.next_id for i, c in enumerate(congruent_cip.core_nodes)}
+        self.next_id += len(core_rename)
+        interface_map.update(core_rename)
+        newcip = nx.relabel_nodes(congruent_cip.graph, interface_map, copy=True)
+
+        # like nx.compose, the attributes of newcip win
+        for n, d in newcip.nodes(data=True):
+            if n in exgraph:
+                entry['changed_nodes'].append((n, dict(exgraph.nodes[n])))
+                exgraph.nodes[n].update(d)
+            else:
+                exgraph.add_node(n, **d)
+        entry['added_nodes'] = list(core_rename.values())
+        for a, b, d in newcip.edges(data=True):
+            if exgraph.has_edge(a, b):
+                entry['changed_edges'].append((a, b, dict(exgraph.edges[a, b])))
+                exgraph.edges[a, b].update(d)
+            else:
+                exgraph.add_edge(a, b, **d)
+                entry['added_edges'].append((a, b))
+        self.log.append(entry)
+        return True
+
+    def undo(self):
+        """revert the last substitution"""
+        entry = self.log.pop()
+        exgraph = self.exgraph
+        exgraph.remove_edges_from(entry['added_edges'])
+        for a, b, d in entry['changed_edges']:
+            exgraph.edges[a, b].clear()
+            exgraph.edges[a, b].update(d)
+        exgraph.remove_nodes_from(entry['added_nodes'])
+        for n, d in entry['changed_nodes']:
+            exgraph.nodes[n].clear()
+            exgraph.nodes[n].update(d)
+        exgraph.add_nodes_from(entry['removed_nodes'])
+        exgraph.add_edges_from(entry['removed_edges'])
+        self.next_id = entry['next_id']
+        self._graph = entry['graph']
+
+    def changes(self):
+        """
+        what the logged substitutions did, see DecompositionContext.update.
+        RETURNS: changed nodes (new or with new neighbors), removed nodes
+        """
+        changed, removed = set(), set()
+        for entry in self.log:
+            changed.update(n for n, d in entry['changed_nodes'])
+            changed.update(entry['added_nodes'])
+            removed.update(n for n, d in entry['removed_nodes'])
+        return [n for n in changed if n in self.exgraph], [n for n in removed if n not in self.exgraph]
+
+    def commit(self):
+        """the substitutions so far can no longer be undone"""
+        self.log = []
+
+    def graph(self):
+        """the current graph as a standalone networkx graph"""
+        if self._graph is None:
+            self._graph = eg._revert_edge_to_vertex_transform(self.exgraph)
+        return self._graph
@@ -18,7 +18,7 @@ class lsgg_ego(graphlearn.sample.LocalSubstitutionGraphGrammarSample):
         return graph.subgraph(cip.get_node_set(id_dist, 0, graph))
     '''
 
-    def _get_cores(self, graph):
+    def _get_cores(self, graph, context=None):
         codes, ego_decomp_fragments = self.encoder(graph)
         #graph = cip._edge_to_vertex(graph)
         return  ego_decomp_fragments
@@ -24,7 +24,7 @@ class lsgg_layered(graphlearn.sample.LocalSubstitutionGraphGrammarSample):
         super(lsgg_layered,self).__init__(**kwargs)
 
 
-    def _get_cip(self, core=None, graph=None):
+    def _get_cip(self, core=None, graph=None, context=None):
 
         """
         whats happening here:
@@ -36,7 +36,8 @@ class lsgg_layered(graphlearn.sample.LocalSubstitutionGraphGrammarSample):
 
         coarse_cip = lsgg_core_interface_pair.CoreInterfacePair(core=core,
                                                              graph=graph,
-                                                             thickness=self.thickness)
+                                                             thickness=self.thickness,
+                                                             context=context)
         base_cip = self._make_base_cip(graph, core)
         if not base_cip:
             return None
@@ -46,6 +47,23 @@ class lsgg_layered(graphlearn.sample.LocalSubstitutionGraphGrammarSample):
         return base_cip
 
 
+    def _get_interface_hash(self, core=None, graph=None, context=None):
+        # the hashes come from the base graph, there is no shortcut
+        cip = self._context_cip(core, graph, context)
+        return cip.interface_hash if cip else None
+
+    def _get_core_hash(self, core=None, graph=None, context=None):
+        return self._context_cip(core, graph, context).core_hash
+
+    def _context_cip(self, core, graph, context):
+        """the cip of core, built once per context: both hashes and _substitutions_core read it"""
+        if context is None:
+            return self._get_cip(core=core, graph=graph)
+        key = frozenset(core.nodes())
+        if key not in context.cips:
+            context.cips[key] = self._cip(core, graph, context)
+        return context.cips[key]
+
     def _make_base_core(self,exp_base_graph, core):
         nodes_in_core = [x for n in core.nodes() for x in core.nodes[n].get('contracted',[]) ]
         edges_in_core = [n for n,d in exp_base_graph.nodes(data=True)
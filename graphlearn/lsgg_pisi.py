@@ -4,6 +4,7 @@ from graphlearn import lsgg_core_interface_pair as CIP
 import networkx as nx
 import numpy as np
 import random
+from collections import OrderedDict
 import  scipy.sparse as sparse
 import logging
 logger = logging.getLogger(__name__)
@@ -12,7 +13,7 @@ from sklearn.metrics.pairwise import cosine_similarity
 
 class CIP_PiSi(CIP.CoreInterfacePair):
 
-    def __init__(self, core, graph, thickness, thickness_pisi):
+    def __init__(self, core, graph, thickness, thickness_pisi, context=None):
         '''
         # preprocess, distances of core neighborhood, init counter
         graph = CIP._edge_to_vertex(graph)
@@ -35,17 +36,47 @@ class CIP_PiSi(CIP.CoreInterfacePair):
         '''
 
         # normal init
-        exgraph, dist = self.initialize_params(core, graph, thickness_pisi)
+        exgraph, dist = self.initialize_params(core, graph, thickness_pisi, context)
         self.core_hash = CIP.graph_hash(core)
         self.core_nodes = list(core.nodes())
         self.graph = exgraph.subgraph([id for id, dst in dist.items() if dst <= thickness])
-        self.interface, self.interface_hash = self.make_interface(exgraph, dist)
+        self.interface, self.interface_hash = self.make_interface(exgraph,
+                {n: d for n, d in dist.items() if d <= thickness}, self.core_nodes, self.graph)
 
         # PISI Stuff
         loosecontext = exgraph.subgraph([i for i,d in dist.items() if 0 < d < thickness_pisi])
         self.pisi_hash = {CIP.graph_hash(loosecontext)}
+        # eden cleans up the graphs it vectorizes, exgraph may be shared -> copy.
+        # eden hashes the labels with hash(), which differs between processes
+        # for strings, the stable hlabels are ints
+        loosecontext = loosecontext.copy()
+        for n, d in loosecontext.nodes(data=True):
+            d['label'] = d['hlabel']
         self.pisi_vectors = CIP.eg.vectorize([loosecontext])
 
+    def freeze(self):
+        return FrozenCIP_PiSi(self)
+
+
+class FrozenCIP_PiSi(CIP.FrozenCIP):
+    # pisi_rows: the pisi hash of each row of the pisi vectors
+    # pisi_vectors: append buffer, a list of sparse blocks whose rows are the
+    #   pisi vectors, _finalize stacks them into one block
+    __slots__ = ('pisi_hash', 'pisi_rows', 'pisi_vectors', 'pisisimilarity')
+    _mutable = ('count', 'pisi_hash', 'pisi_rows', 'pisi_vectors', 'pisisimilarity')
+
+    def __init__(self, cip):
+        super(FrozenCIP_PiSi, self).__init__(cip)
+        object.__setattr__(self, 'pisi_hash', set(cip.pisi_hash))
+        object.__setattr__(self, 'pisi_rows', list(cip.pisi_hash))
+        object.__setattr__(self, 'pisi_vectors', [cip.pisi_vectors])
+
+
+def _finalize(cip):
+    """the pisi vectors of a frozen cip as one csr matrix"""
+    if len(cip.pisi_vectors) > 1 or not sparse.isspmatrix_csr(cip.pisi_vectors[0]):
+        cip.pisi_vectors = [sparse.vstack(cip.pisi_vectors, format='csr')]
+    return cip.pisi_vectors[0]
 
 
 class PiSi(graphlearn.sample.LocalSubstitutionGraphGrammarSample):
@@ -54,25 +85,59 @@ class PiSi(graphlearn.sample.LocalSubstitutionGraphGrammarSample):
     def __init__(self,thickness_pisi, **kwargs):
         super(PiSi,self).__init__(**kwargs)
         self.thickness_pisi = thickness_pisi*2
+        # {interface_hash: (cips, their stacked pisi vectors, first row of each cip)}, see _pisi_interface
+        self._pisi_index = OrderedDict()
 
-    def _get_cip(self, core=None, graph=None):
-        return CIP_PiSi( core=core, graph=graph,thickness=self.thickness,  thickness_pisi=self.thickness_pisi)
+    def _get_cip(self, core=None, graph=None, context=None):
+        return CIP_PiSi( core=core, graph=graph,thickness=self.thickness,  thickness_pisi=self.thickness_pisi, context=context)
     
+    def _index_productions(self):
+        super(PiSi, self)._index_productions()
+        self._pisi_index = OrderedDict()
+
+    def _invalidate_index(self):
+        super(PiSi, self)._invalidate_index()
+        self._pisi_index = OrderedDict()
+
+    def _empty_copy(self):
+        grammar = super(PiSi, self)._empty_copy()
+        grammar._pisi_index = OrderedDict()
+        return grammar
+
+    def _pisi_interface(self, interface):
+        """
+        the cips of interface and their pisi vectors in one csr matrix, built on first use.
+        with LazyProductions only its max_interfaces most recently used interfaces are kept
+        """
+        index = self._pisi_index.get(interface)
+        if index is not None:
+            self._pisi_index.move_to_end(interface)
+            return index
+        cips = list(self.productions.get(interface, {}).values())
+        blocks = [_finalize(cip) for cip in cips]
+        offsets = np.cumsum([0] + [block.shape[0] for block in blocks[:-1]])
+        matrix = sparse.vstack(blocks, format='csr') if blocks else None
+        index = self._pisi_index[interface] = cips, matrix, offsets
+        max_interfaces = getattr(self.productions, 'max_interfaces', None)
+        if max_interfaces is not None and len(self._pisi_index) > max_interfaces:
+            self._pisi_index.popitem(last=False)
+        return index
+
     def _get_congruent_cips(self, cip):
-        cips = self.productions.get(cip.interface_hash, {}).values()
+        cips, matrix, offsets = self._pisi_interface(cip.interface_hash)
         if len(cips) == 0:
             logger.log(10,"no congruent cip in grammar")
-        else: 
-            cips_ = [(cip_,np.max( cip_.pisi_vectors.dot(cip.pisi_vectors.toarray()[0])))
-                         for cip_ in cips if cip_.core_hash != cip.core_hash]
-             
-            cips_ = [ (a,b) for a,b in cips_ if b > 0]
-
-            if len(cips_) == 0: logger.log(10,"0 cips with pisi-similarity > 0")
-            for cip_, di in cips_:
-                cip_.pisisimilarity=di
-                yield cip_
-    
+            return
+        # one product for the rows of all cips, then the max over the rows of each cip
+        similarity = np.maximum.reduceat(matrix.dot(cip.pisi_vectors.T).toarray().ravel(), offsets)
+        cips_ = [(cip_, di) for cip_, di in zip(cips, similarity)
+                 if cip_.core_hash != cip.core_hash and di > 0]
+
+        if len(cips_) == 0: logger.log(10,"0 cips with pisi-similarity > 0")
+        for cip_, di in cips_:
+            cip_.pisisimilarity=di
+            yield cip_
+
     def _sample_size_adjusted(self, subs):
         sim = [c[1].pisisimilarity for c in subs ]
         logger.log(10, "pisi similarities: "+str(sim))
@@ -81,12 +146,23 @@ class PiSi(graphlearn.sample.LocalSubstitutionGraphGrammarSample):
 
 
     def _store_cip(self, cip):
-                    
-        grammarcip = self.productions[cip.interface_hash].setdefault(cip.core_hash, cip)
+        grammarcip = self._grammar_cip(cip)
         grammarcip.count+=1
-        if not grammarcip.pisi_hash.intersection(cip.pisi_hash): 
-            grammarcip.pisi_vectors= sparse.vstack( (grammarcip.pisi_vectors,  cip.pisi_vectors))
-            grammarcip.pisi_hash= grammarcip.pisi_hash.union(cip.pisi_hash)
+        if not grammarcip.pisi_hash.intersection(cip.pisi_hash):
+            grammarcip.pisi_vectors.append(cip.pisi_vectors)
+            grammarcip.pisi_hash.update(cip.pisi_hash)
+            grammarcip.pisi_rows.extend(cip.pisi_hash)
+
+    def _merge_cip(self, cip):
+        grammarcip = self.productions[cip.interface_hash].setdefault(cip.core_hash, cip)
+        if grammarcip is cip:
+            return
+        grammarcip.count += cip.count
+        new = [i for i, h in enumerate(cip.pisi_rows) if h not in grammarcip.pisi_hash]
+        if new:
+            grammarcip.pisi_vectors.append(_finalize(cip)[new])
+            grammarcip.pisi_hash.update(cip.pisi_rows[i] for i in new)
+            grammarcip.pisi_rows.extend(cip.pisi_rows[i] for i in new)
 
     def __repr__(self):
         """repr."""
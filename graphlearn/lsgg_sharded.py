@@ -0,0 +1,288 @@
+"""
+a grammar whose productions are spread over several processes.
+
+the productions of an interface live in shard interface_hash % n_shards.
+fitting works like the map-reduce fit of LocalSubstitutionGraphGrammar, the
+partial productions are merged in the shards instead of the parent, and each
+shard filters its interfaces (all filters work per interface).
+partial_fit keeps the raw productions in the shards as well, refilter and
+the twopass fit work as in LocalSubstitutionGraphGrammar.
+when sampling, congruent cips are looked up in the shard of their interface.
+processes forked from the one that made the shards (e.g. the workers of a
+ParallelSampler) connect to the shards on their own, replies never cross.
+"""
+
+from collections import defaultdict
+from collections.abc import Mapping
+import copy
+import functools
+import multiprocessing as mp
+from multiprocessing.connection import Client, Listener
+import os
+import threading
+import graphlearn.sample
+from graphlearn.local_substitution_graph_grammar import _check_reiterable
+from graphlearn.util.multi import chunks
+import logging
+logger = logging.getLogger(__name__)
+
+
+class ShardedGrammar(graphlearn.sample.LocalSubstitutionGraphGrammarSample):
+
+    def __init__(self, n_shards=2, **kwargs):
+        super(ShardedGrammar, self).__init__(**kwargs)
+        self.n_shards = n_shards
+        self._shards = []
+        self.productions = ShardedProductions(self)
+
+    def __getstate__(self):
+        # the shards belong to this process, copies start without productions
+        state = dict(self.__dict__)
+        state['_shards'] = []
+        state['productions'] = defaultdict(dict)
+        return state
+
+    def fit(self, graphs, n_jobs=1, batch_size=None, chunksize=10, twopass=False, pool=None):
+        """arguments as in LocalSubstitutionGraphGrammar.fit, the productions go to new shards"""
+        self.close()
+        self._start_hash_scheme()
+        self._start_shards()
+        keep = None
+        if twopass:
+            _check_reiterable(graphs)
+            if n_jobs == 1 and pool is None:
+                counts = self._count_hashes(graphs)
+            else:
+                counts = self._count_hashes_parallel(graphs, n_jobs, batch_size, chunksize, pool)
+            keep = self._filter_counts(counts)
+        for productions in self._partials(graphs, n_jobs, batch_size, chunksize, pool, keep):
+            self._merge_productions(productions)
+        if not twopass:
+            self._call_all(_filter)
+        self._index_productions()
+        return self
+
+    def partial_fit(self, graphs, n_jobs=1, batch_size=None, chunksize=10, pool=None):
+        """arguments as in LocalSubstitutionGraphGrammar.partial_fit, each shard
+        keeps the raw productions of its interfaces"""
+        self._start_hash_scheme()
+        if not self._shards:
+            self._start_shards()
+        for productions in self._partials(graphs, n_jobs, batch_size, chunksize, pool):
+            self._merge_productions(productions, _merge_raw)
+        return self.refilter()
+
+    def refilter(self, **filter_args):
+        """see LocalSubstitutionGraphGrammar.refilter, every shard filters its raw productions"""
+        if not self._shards:
+            raise ValueError('refilter needs the raw productions of partial_fit')
+        self._call_all(_refilter, [(filter_args,)] * len(self._shards))
+        for name, value in filter_args.items():
+            setattr(self, name, value)
+        self._index_productions()
+        return self
+
+    def _start_shards(self):
+        self._interface_index = None
+        self._shards = [Shard(copy.copy(self)) for i in range(self.n_shards)]
+
+    def _partials(self, graphs, n_jobs, batch_size, chunksize, pool, keep=None):
+        if n_jobs == 1 and pool is None:
+            return map(functools.partial(self._make_productions, keep=keep), chunks(graphs, chunksize))
+        return self._pmap('_make_productions', graphs, n_jobs, batch_size, chunksize, pool, keep=keep)
+
+    def _merge_productions(self, productions, merge=None):
+        self._invalidate_index()
+        parts = [{} for shard in self._shards]
+        for interface, cips in productions.items():
+            parts[interface % self.n_shards][interface] = cips
+        self._call_all(merge or _merge, [(part,) for part in parts])
+
+    def _get_congruent_cips(self, cip):
+        return self._shard(cip.interface_hash).call(_congruent, cip.interface_hash, cip.core_hash)
+
+    def size(self):
+        sizes = self._call_all(_size)
+        n_interfaces, cores, n_cips, n_productions = zip(*sizes)
+        return sum(n_interfaces), len(set().union(*cores)), sum(n_cips), sum(n_productions)
+
+    def close(self):
+        """stop the shard processes, the productions are gone afterwards"""
+        for shard in self._shards:
+            shard.close()
+        self._shards = []
+
+    def _shard(self, interface):
+        return self._shards[interface % self.n_shards]
+
+    def _call_all(self, func, argslist=None):
+        """func(shardgrammar, *args) in all shards at once, argslist has the args of each shard"""
+        argslist = argslist or [()] * len(self._shards)
+        for shard, args in zip(self._shards, argslist):
+            shard.send(func, *args)
+        # all replies are read before an error is raised, or they would be
+        # taken for the replies of the next call
+        results, error = [], None
+        for shard in self._shards:
+            try:
+                results.append(shard.recv())
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
+        return results
+
+
+class ShardedProductions(Mapping):
+    """read only {interface_hash: {core_hash: cip}} view of the shards"""
+
+    def __init__(self, grammar):
+        self.grammar = grammar
+
+    def __getitem__(self, interface):
+        if not self.grammar._shards:
+            raise KeyError(interface)
+        cips = self.grammar._shard(interface).call(_interface, interface)
+        if cips is None:
+            raise KeyError(interface)
+        return cips
+
+    def __iter__(self):
+        for interfaces in self.grammar._call_all(_interfaces):
+            for interface in interfaces:
+                yield interface
+
+    def __len__(self):
+        return sum(self.grammar._call_all(_len))
+
+
+class Shard(object):
+    """
+    a process holding a grammar, runs func(grammar, *args) on request.
+
+    the pipe made with the process belongs to the process that started it,
+    forked processes would share it and read each other's replies. they
+    connect to the listener of the shard instead, one connection per process.
+    """
+
+    def __init__(self, grammar):
+        self.conn, child = mp.Pipe()
+        self.process = mp.Process(target=_serve, args=(child, grammar), daemon=True)
+        self.process.start()
+        child.close()
+        self.address = self.conn.recv()
+        self.owner = self.pid = os.getpid()
+
+    def _connection(self):
+        if self.pid != os.getpid():
+            self.conn = Client(self.address, authkey=mp.current_process().authkey)
+            self.pid = os.getpid()
+        return self.conn
+
+    def send(self, func, *args):
+        self._connection().send((func, args))
+
+    def recv(self):
+        ok, result = self._connection().recv()
+        if not ok:
+            raise result
+        return result
+
+    def call(self, func, *args):
+        self.send(func, *args)
+        return self.recv()
+
+    def close(self):
+        """stop the shard process, in other processes only their connection is closed"""
+        if self.pid == os.getpid():
+            if self.owner == self.pid and self.process.is_alive():
+                self.conn.send(None)
+                self.process.join()
+            self.conn.close()
+
+
+def _serve(conn, grammar):
+    # requests of all connections are served one at a time
+    lock = threading.Lock()
+    listener = Listener(authkey=mp.current_process().authkey)
+    threading.Thread(target=_accept, args=(listener, grammar, lock), daemon=True).start()
+    conn.send(listener.address)
+    _handle(conn, grammar, lock)
+    listener.close()
+
+
+def _accept(listener, grammar, lock):
+    while True:
+        try:
+            conn = listener.accept()
+        except mp.AuthenticationError:
+            continue
+        except OSError:
+            break
+        threading.Thread(target=_handle, args=(conn, grammar, lock), daemon=True).start()
+
+
+def _handle(conn, grammar, lock):
+    """serve the requests of conn until it sends None or is closed"""
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        func, args = request
+        with lock:
+            try:
+                reply = (True, func(grammar, *args))
+            except Exception as e:
+                reply = (False, e)
+        conn.send(reply)
+    conn.close()
+
+
+###########
+# what the shards can do
+###########
+def _merge(grammar, productions):
+    # the shard grammar is a copy of the ShardedGrammar, merge locally
+    super(ShardedGrammar, grammar)._merge_productions(productions)
+
+
+def _merge_raw(grammar, productions):
+    if grammar.raw_productions is None:
+        grammar.raw_productions = defaultdict(dict)
+    grammar.productions = grammar.raw_productions
+    _merge(grammar, productions)
+
+
+def _filter(grammar):
+    grammar._filter_cips()
+
+
+def _refilter(grammar, filter_args):
+    super(ShardedGrammar, grammar).refilter(**filter_args)
+
+
+def _congruent(grammar, interface, core):
+    cips = grammar.productions.get(interface, {}).values()
+    return [cip for cip in cips if cip.core_hash != core]
+
+
+def _interface(grammar, interface):
+    return grammar.productions.get(interface)
+
+
+def _interfaces(grammar):
+    return list(grammar.productions.keys())
+
+
+def _len(grammar):
+    return len(grammar.productions)
+
+
+def _size(grammar):
+    cores = set(core for cips in grammar.productions.values() for core in cips)
+    n_cips = sum(len(cips) for cips in grammar.productions.values())
+    n_productions = sum(len(cips) * (len(cips) - 1) for cips in grammar.productions.values())
+    return len(grammar.productions), cores, n_cips, n_productions
@@ -1,9 +1,18 @@
 import numpy as np
+from collections import deque
+import copy
+import functools
+import multiprocessing as mp
+import os
+import pickle
 
 from graphlearn.local_substitution_graph_grammar import LocalSubstitutionGraphGrammar, logger
+from graphlearn.lsgg_core_interface_pair import WorkingGraph
 from graphlearn.util import util
+from graphlearn.util.multi import WorkerPool, chunks
 import random
 from graphlearn.choice import SelectMax
+from graphlearn.score import CachedEstimator
 
 import logging
 logger = logging.getLogger(__name__)
@@ -50,51 +59,166 @@ class Sampler(object):
     def __init__(self,**sampleargs):
         self.faster=False
         self.num_sample = 1
+        # proposals per scorer call in sample_step_multi
+        self.batch_size = 32
+        # inplace: proposals are applied to a WorkingGraph and undone after scoring
+        self.inplace = False
+        # backtrack_depth: dead ends in a row that sample_step can backtrack through
+        self.backtrack_depth = 10
+        # the history is kept for backtracking only. a dead end drops the top
+        # entry and continues from the one below, so each dead end in a row
+        # takes 2 entries. history_size defaults to 2 * backtrack_depth, only
+        # the last history_size entries are kept (None: all of them)
+        # checkpoint: a file the chain state is written to every checkpoint_every steps
+        self.checkpoint = None
+        self.checkpoint_every = 10
+        # score_cache: scores of this many graphs are kept, see score.CachedEstimator
+        self.score_cache = 0
+        # pipeline: a producer process makes the proposals while this one scores
+        # them, at most pipeline_depth batches ahead, see _Producer
+        self.pipeline = False
+        self.pipeline_depth = 2
+        self._producer = None
         self.__dict__.update(sampleargs)
-        self.history=[]
+        if 'history_size' not in sampleargs:
+            self.history_size = 2 * self.backtrack_depth
+        self.history = deque(maxlen=self.history_size)
+        if self.score_cache:
+            self.scorer = CachedEstimator(self.scorer, self.score_cache)
         
     
+    def __getstate__(self):
+        # the producer process belongs to this process
+        state = dict(self.__dict__)
+        state['_producer'] = None
+        return state
+
+    def close(self):
+        """stop the producer process of the pipeline"""
+        if self._producer is not None:
+            self._producer.close()
+            self._producer = None
+
     def sample_sizeconstraint(self,graph, penalty=0.0):
         self.scorer.sizefactor = len(graph)
         self.scorer.sizepenalty = penalty
         return self.sample(graph)
 
     def sample_burnin(self,graph):
-        res= []
-        for i in range(self.n_steps):
-            if self.num_sample==1:
+        return self._run_chain(graph, True)
+            
+    def sample(self,graph):
+        return self._run_chain(graph, False)
+
+    def resume(self, path=None):
+        """continue the chain in the checkpoint file (default: self.checkpoint), returns as the sampling method did"""
+        with open(path or self.checkpoint, 'rb') as f:
+            state = pickle.load(f)
+        random.setstate(state['random'])
+        np.random.set_state(state['np_random'])
+        self.history = deque(state['history'], maxlen=self.history_size)
+        return self._run_chain(state['graph'], state['burnin'], state['step'], state['results'])
+
+    def save_checkpoint(self, graph, step, burnin=False, results=()):
+        """write the chain state, replacing the file at once so a kill can not leave half of it"""
+        state = dict(graph=graph, step=step, burnin=burnin, results=list(results), history=list(self.history),
+                     random=random.getstate(), np_random=np.random.get_state())
+        tmp = self.checkpoint + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.checkpoint)
+
+    def _run_chain(self, graph, burnin, start=0, res=None):
+        res = [] if res is None else res
+        if self.inplace:
+            work = WorkingGraph(self.transformer.encode_single(graph))
+            context = self.grammar._get_context(work.exgraph)
+        current = lambda: self.transformer._decode_single(work.graph()) if self.inplace else graph
+        for i in range(start, self.n_steps):
+            if self.inplace:
+                self.sample_step_inplace(work, i, context)
+            elif self.num_sample==1 or not burnin:
                 graph, score = self.sample_step(graph,i)
             else:
                 graph,score = self.sample_step_multi(graph,i)
-            if i >= self.burnin: 
+            if burnin and i >= self.burnin: 
                 if (i - self.burnin) % self.emit ==0:
-                    res.append(graph)
-        return res
-            
-    def sample(self,graph):
-        for i in range(self.n_steps):
-            graph, score = self.sample_step(graph,i)
-        return graph
+                    res.append(current())
+            if self.checkpoint and (i + 1) % self.checkpoint_every == 0:
+                self.save_checkpoint(current(), i + 1, burnin, res)
+        return res if burnin else current()
+
+    def _score(self, objects, parent):
+        # scorers with delta set vectorize the proposals relative to their parent
+        if getattr(self.scorer, 'delta', False):
+            return self.scorer.decision_function(objects, parent=parent)
+        return self.scorer.decision_function(objects)
+
+    def sample_step_inplace(self, work, step, context=None):
+        """
+        sample_step on a WorkingGraph: the num_sample proposals are applied in
+        place and undone after they are materialized for scoring, the
+        selected one is applied again. returns the score of the new state.
+        the selector has to return one of the proposal objects it is given,
+        selectors that return several (SelectMaxN, SelectProbN with n > 1) do not work.
+
+        context: the DecompositionContext of work.exgraph, kept by the chain.
+            it is updated after a substitution, so only cores near the
+            change are decomposed again in the next step.
+        """
+        util.valid_gl_graph(work.graph())
+        if context is None:
+            context = self.grammar._get_context(work.exgraph)
+        substitutions, proposal_graphs = [], []
+        for cip, congruent_cip in self.grammar.substitutions_sample(work.exgraph, context):
+            if len(substitutions) == self.num_sample:
+                break
+            if work.substitute(cip, congruent_cip):
+                substitutions.append((cip, congruent_cip))
+                proposal_graphs.append(work.graph())
+                work.undo()
+        if not substitutions:
+            logger.log(10, "reached a dead-end graph at step %d" % step)
+        proposal_objects = [self.transformer._decode_single(g) for g in proposal_graphs + [work.graph()]]
+        scores = self._score(proposal_objects, proposal_objects[-1])
+        obj, score = self.selector.select(proposal_objects, scores)
+        choice = next((i for i, o in enumerate(proposal_objects) if o is obj), None)
+        if choice is None:
+            raise ValueError('inplace sampling needs a selector that returns one of the proposals, '
+                             'like SelectMax (not SelectMaxN, or SelectProbN with n > 1)')
+        if choice < len(substitutions):
+            work.substitute(*substitutions[choice])
+            self.grammar._update_context(context, *work.changes())
+            work.commit()
+        self.history.append((obj, score))
+        return score
 
     def sample_step(self,object,step):
         if object is None: return None,0
         graph = self.transformer.encode_single(object)
         util.valid_gl_graph(graph)
-        if self.faster:
-            proposal_graphs = list(self.grammar.neighbors_sample_faster(graph,1))+[graph]
+        method = 'neighbors_sample_faster' if self.faster else 'neighbors_sample'
+        if self.pipeline:
+            # the current graph is scored while its neighbor is made
+            batches = self._proposals(graph, 1, 1, method)
+            current = self.transformer._decode_single(graph)
+            current_score = self._score([current], object)[0]
+            proposal_objects = [o for batch in batches for o in batch] + [current]
         else:
-            proposal_graphs = list(self.grammar.neighbors_sample(graph,1))+[graph]
-
-        proposal_objects = list(self.transformer.decode(proposal_graphs))
+            proposal_graphs = list(getattr(self.grammar, method)(graph,1))+[graph]
+            proposal_objects = list(self.transformer.decode(proposal_graphs))
         
         if len(proposal_objects) <= 1: 
-            logger.log(10,"reached a dead-end graph, attempting to backtrack at step " % step)
+            logger.log(10,"reached a dead-end graph, attempting to backtrack at step %d" % step)
             if len(self.history) < 2:
                 return None,0
             self.history.pop() # the problematic graph should be on top of the stack
             return self.history.pop() 
 
-        scores = self.scorer.decision_function(proposal_objects)
+        if self.pipeline:
+            scores = list(self._score(proposal_objects[:-1], object)) + [current_score]
+        else:
+            scores = self._score(proposal_objects, object)
         obj_score = self.selector.select(proposal_objects, scores)
         self.history.append(obj_score)
         return obj_score
@@ -105,17 +229,20 @@ class Sampler(object):
         # a graph is something that the grammar understands
         graph = self.transformer.encode_single(object)
         util.valid_gl_graph(graph)
-        startscore = self.scorer.decision_function([object])[0]
+        # with pipeline set, the producer starts on the proposals now
+        batches = self._proposals(graph, self.num_sample, self.batch_size)
+        startscore = self._score([object], object)[0]
         current = graph, startscore
         scorehist= [] 
         backupmgr = Backupmgr(15)
-        for g in self.grammar.neighbors_sample(graph, self.num_sample):
-            proposal_object = self.transformer._decode_single(g)
-            score = self.scorer.decision_function([proposal_object])[0]
-            scorehist.append(score)
-            backupmgr.push((score,proposal_object))
-            if score > current[1]:
-                current = proposal_object,score
+        # proposals are scored batch_size at a time, in the order they are made
+        for proposal_objects in batches:
+            scores = self._score(proposal_objects, object)
+            for proposal_object, score in zip(proposal_objects, scores):
+                scorehist.append(score)
+                backupmgr.push((score,proposal_object))
+                if score > current[1]:
+                    current = proposal_object,score
         
         if startscore == current[1]:
             score,pobj = backupmgr.get() 
@@ -125,6 +252,144 @@ class Sampler(object):
         self.history.append(current)
         return current
 
+    def _proposals(self, graph, n, batch_size, method='neighbors_sample'):
+        """the decoded proposals of grammar.method(graph, n) in batches of batch_size"""
+        # daemonic processes, e.g. the workers of a ParallelSampler, can not start a producer
+        if not self.pipeline or mp.current_process().daemon:
+            return _proposals(self, graph, n, batch_size, method)
+        if self._producer is None or self._producer.pid != os.getpid():
+            self._producer = _Producer(self, self.pipeline_depth)
+        return self._producer.proposals(graph, n, batch_size, method)
+
+
+def _proposals(sampler, graph, n, batch_size, method):
+    return ([sampler.transformer._decode_single(g) for g in graphs]
+            for graphs in chunks(getattr(sampler.grammar, method)(graph, n), batch_size))
+
+
+class _Producer(object):
+    """
+    a process that makes the proposals of a sampler (grammar.neighbors_sample
+    and transformer._decode_single, see Sampler._proposals) and sends them in batches through a queue
+    of depth batches, while the sampler scores the ones it has.
+
+    it is forked on first use with the grammar and transformer of that
+    moment. the proposals draw from the random and np.random states of the
+    chain, which go to the producer with each request and come back with
+    the last batch, so the chain samples as it does without the pipeline
+    (unless the scorer draws random numbers too).
+    """
+
+    def __init__(self, sampler, depth):
+        self.requests = mp.Queue()
+        self.batches = mp.Queue(depth)
+        self.process = mp.Process(target=_produce, args=(sampler, self.requests, self.batches), daemon=True)
+        self.process.start()
+        self.pid = os.getpid()
+
+    def proposals(self, graph, n, batch_size, method):
+        self.requests.put((graph, n, batch_size, method, random.getstate(), np.random.get_state()))
+        return self._receive()
+
+    def _receive(self):
+        done = False
+        try:
+            while True:
+                kind, value = self.batches.get()
+                if kind == 'error':
+                    done = True
+                    raise value
+                if kind == 'done':
+                    done = True
+                    random.setstate(value[0])
+                    np.random.set_state(value[1])
+                    return
+                yield value
+        finally:
+            # batches that were not taken would be read by the next request
+            while not done:
+                done = self.batches.get()[0] != 'batch'
+
+    def close(self):
+        if self.pid == os.getpid() and self.process.is_alive():
+            self.requests.put(None)
+            self.process.join()
+
+
+def _produce(sampler, requests, batches):
+    for graph, n, batch_size, method, state, np_state in iter(requests.get, None):
+        random.setstate(state)
+        np.random.set_state(np_state)
+        try:
+            for batch in _proposals(sampler, graph, n, batch_size, method):
+                batches.put(('batch', batch))
+            batches.put(('done', (random.getstate(), np.random.get_state())))
+        except Exception as e:
+            batches.put(('error', e))
+
+
+class ParallelSampler(object):
+    """
+    one chain per graph, the chains run in a pool of processes.
+
+        chains = ParallelSampler(Sampler(grammar=.., scorer=.., ..), n_jobs=8, seed=0)
+        for i, graph in chains.sample(graphs): ...
+
+    the workers are forked with the sampler resident, so grammar and scorer
+    are shared copy-on-write and not pickled per chain (a scorer should not
+    use a WorkerPool of its own here). with a pool, e.g. one shared with fit
+    and the scorer, the sampler is pickled once per call instead, grammars
+    that do not pickle their productions (ShardedGrammar) need n_jobs.
+    every chain seeds random and np.random from its own SeedSequence child,
+    the results do not depend on n_jobs. with sampler.checkpoint set, chain i
+    writes to checkpoint.i. the workers are daemonic and can not start the
+    producer of a pipelined sampler, its chains make their proposals without
+    one when n_jobs > 1 (or a pool is given)
+    """
+
+    def __init__(self, sampler, n_jobs=2, seed=None, pool=None):
+        self.sampler = sampler
+        self.n_jobs = n_jobs
+        self.seed = seed
+        self.pool = pool
+
+    def sample(self, graphs):
+        """(index of the graph, Sampler.sample(graph)) in the order the chains finish"""
+        return self._run('sample', graphs)
+
+    def sample_burnin(self, graphs):
+        """as sample, with Sampler.sample_burnin"""
+        return self._run('sample_burnin', graphs)
+
+    def _run(self, method, graphs):
+        seeds = np.random.SeedSequence(self.seed)
+        tasks = ((i, graph, seeds.spawn(1)[0]) for i, graph in enumerate(graphs))
+        chain = functools.partial(_chain, self.sampler, method)
+        if self.pool is not None:
+            for result in self.pool.imap('chain', tasks, resident={'chain': chain}):
+                yield result
+            return
+        if self.n_jobs == 1:
+            for task in tasks:
+                yield chain(task)
+            return
+        with WorkerPool(self.n_jobs, chain=chain) as pool:
+            for result in pool.imap('chain', tasks):
+                yield result
+
+
+def _chain(sampler, method, task):
+    i, graph, seed = task
+    state = seed.generate_state(2)
+    random.seed(int(state[0]) << 32 | int(state[1]))
+    np.random.seed(state)
+    sampler = copy.copy(sampler)
+    sampler.history = deque(maxlen=sampler.history_size)
+    if sampler.checkpoint:
+        sampler.checkpoint = '%s.%d' % (sampler.checkpoint, i)
+    return i, getattr(sampler, method)(graph)
+
+
 class Backupmgr():
     def __init__(self, maxsize):
         self.maxsize = maxsize 
@@ -174,26 +439,49 @@ class LocalSubstitutionGraphGrammarSample(LocalSubstitutionGraphGrammar):
                 p=p)
         return [subs[i] for i in samples[::-1]]
 
-    def neighbors_core(self, graph, core):
+    def neighbors_core(self, graph, core, context=None):
         """iterator over all neighbors of graph (that are conceiveable by the grammar)"""
-
-        graph_cip = self._get_cip(core, graph)
-        cip_substitutions = [(graph_cip, congruent_cip)
-                             for congruent_cip in self._get_congruent_cips(graph_cip)]
-
-        for cip, congruent_cip in  self._sample_size_adjusted(cip_substitutions):
-            graph_ = self._substitute_core(graph, cip, congruent_cip)
+        for cip, congruent_cip in self._substitutions_core(graph, core, context):
+            graph_ = self._substitute(graph, cip, congruent_cip)
             if graph_ is not None:
                 yield graph_
 
+    def _substitutions_core(self, graph, core, context=None):
+        if context is None:
+            graph_cip = self._cip(core, graph, context)
+        else:
+            key = frozenset(core.nodes())
+            if key not in context.cips:
+                context.cips[key] = self._cip(core, graph, context)
+            graph_cip = context.cips[key]
+        cip_substitutions = [(graph_cip, congruent_cip)
+                             for congruent_cip in self._congruent(graph_cip)]
+        return self._sample_size_adjusted(cip_substitutions)
+
     def neighbors_sample(self, graph, n_neighbors):
         """neighbors_sample. might be a little bit faster by avoiding cip extractions,
         chooses a node first and then picks form the subs evenly
         """
-        cores = list(self._get_cores(graph))
+        if n_neighbors <= 0:
+            return
+        context = self._get_context(graph)
+        for cip, congruent_cip in self.substitutions_sample(graph, context):
+            graph_ = self._substitute(graph, cip, congruent_cip)
+            if graph_ is not None:
+                yield graph_
+                n_neighbors = n_neighbors - 1
+                if n_neighbors == 0:
+                    return
+
+    def substitutions_sample(self, graph, context=None):
+        """the (cip, congruent cip) pairs in the order neighbors_sample tries them,
+        to apply them elsewhere, e.g. to a WorkingGraph"""
+        context = context or self._get_context(graph)
+        # cores without productions are skipped before their cip is built
+        cores = list(self._applicable_cores(graph, context))
         random.shuffle(cores)
         for core in cores:
-            for graph_ in self.neighbors_core(graph, core):
-                if n_neighbors > 0:
-                    yield graph_
-                    n_neighbors = n_neighbors - 1
+            if isinstance(core, tuple):
+                core = context.core(*core)
+            for substitution in self._substitutions_core(graph, core, context):
+                yield substitution
@@ -7,7 +7,10 @@ from sklearn.metrics.pairwise import cosine_similarity
 from sklearn.svm import OneClassSVM
 import random
 import numpy as np
-from graphlearn.util.multi import mpmap
+from graphlearn.util.multi import WorkerPool, chunks
+from graphlearn.util.deltavec import DeltaVectorizer
+from graphlearn import lsgg_core_interface_pair as lcip
+from collections import OrderedDict
 import scipy as sp
 import logging 
 logger = logging.getLogger(__name__)
@@ -27,26 +30,50 @@ class SimpleDistanceEstimator():
 
 class OneClassEstimator():
     
-    def __init__(self,model=None, n_jobs=1,vectorizer=Vectorizer()):
+    def __init__(self,model=None, n_jobs=1,vectorizer=Vectorizer(), delta=False, pool=None):
+        '''
+        delta: proposals are vectorized by patching the vector of their parent,
+            see graphlearn.util.deltavec. used when decision_function gets a parent.
+        pool: a WorkerPool, e.g. one shared with the grammar and the sampler.
+            if the vectorizer is not resident in it, it is sent with every
+            transform. with n_jobs > 1 and no pool, one is started by the
+            first transform and kept.
+        '''
         if not model: 
             self.model = OneClassSVM(gamma='auto')
         else:
             self.model=model
         self.n_jobs=n_jobs
         self.vectorizer=vectorizer
+        self.delta = delta
+        self.deltavectorizer = DeltaVectorizer(vectorizer)
+        self.pool = pool
+
+    def __getstate__(self):
+        # the pool stays in this process
+        state = dict(self.__dict__)
+        state['pool'] = None
+        return state
     
-    def transform(self,graphs):
-        if self.n_jobs==1:
+    def transform(self,graphs, parent=None):
+        if parent is not None and getattr(self, 'delta', False):
+            return self.deltavectorizer.transform(graphs, parent)
+        if self.n_jobs==1 and getattr(self, 'pool', None) is None:
             return self.vectorizer.transform(graphs)
-        else: 
-            return sp.sparse.vstack( mpmap( self.vectorizer.transform, [[g] for g in graphs], poolsize=self.n_jobs ) ) 
+        if getattr(self, 'pool', None) is None:
+            self.pool = WorkerPool(self.n_jobs, vectorizer=self.vectorizer)
+        # chunksize looks at the first graph and the number of graphs
+        graphs = list(graphs)
+        batches = list(chunks(graphs, self.pool.chunksize(graphs)))
+        resident = None if self.pool.resident.get('vectorizer') is self.vectorizer else {'vectorizer': self.vectorizer}
+        return sp.sparse.vstack(self.pool.map('vectorizer.transform', batches, chunksize=1, resident=resident))
 
     def fit(self,graphs):
         self.model.fit(self.transform(graphs) )
         return self
 
-    def decision_function(self, graphs):
-        vecs = self.transform(graphs)
+    def decision_function(self, graphs, parent=None):
+        vecs = self.transform(graphs, parent)
         return self.model.decision_function(vecs)
 
 class OneClassSizeHarmMean(OneClassEstimator):
@@ -59,8 +86,8 @@ class OneClassSizeHarmMean(OneClassEstimator):
         super().fit(graphs)
         return self
 
-    def decision_function(self,graphs):
-        vecs = self.transform(graphs)
+    def decision_function(self,graphs, parent=None):
+        vecs = self.transform(graphs, parent)
         scores =  self.model.decision_function(vecs)
         scores2 = [sp.stats.logistic.cdf(a,0,1) for a in scores]
         norm = lambda x:  np.exp(-(((len(x)-self.size_mean)/self.size_std)**2)*.5) 
@@ -73,15 +100,88 @@ class OneClassSizeHarmMean(OneClassEstimator):
         return res
 
 class OneClassAndSizeFactor(OneClassEstimator):
-    def decision_function(self,graphs):
+    def decision_function(self,graphs, parent=None):
         if 'sizefactor' not in self.__dict__:
             print ("OneClassAndSizeFactor has no size factor")
-        vecs = self.transform(graphs)
+        vecs = self.transform(graphs, parent)
         return self.model.decision_function(vecs)*np.array([self.sizepen(x) for x in graphs])
     def sizepen(self,g):
         diff =  abs(len(g) - self.sizefactor)
         return 1 - diff*self.sizepenalty
 
+class CachedEstimator():
+    '''
+    scores of an estimator, cached by graph hash.
+
+    graphs scored before (the maxsize most recently used ones) and duplicates
+    within one call are not scored again. chains in one process can share
+    the cache by passing the same OrderedDict as cache.
+    hits and misses count the graphs that were and were not looked up.
+
+    other attributes are those of the estimator. the ones set through the
+    cache (e.g. sizefactor by sample_sizeconstraint) are part of the cache
+    key, so a shared cache does not mix scores of different settings.
+    '''
+    _own = ('estimator', 'maxsize', 'cache', 'hits', 'misses', '_state', '_state_key')
+
+    def __init__(self, estimator, maxsize=10000, cache=None):
+        self.estimator = estimator
+        self.maxsize = maxsize
+        self.cache = OrderedDict() if cache is None else cache
+        self.hits, self.misses = 0, 0
+        self._state = {}
+        self._state_key = ()
+
+    def __getattr__(self, name):
+        if name in self._own:
+            raise AttributeError(name)
+        return getattr(self.estimator, name)
+
+    def __setattr__(self, name, value):
+        if name in self._own:
+            object.__setattr__(self, name, value)
+            return
+        setattr(self.estimator, name, value)
+        self._state[name] = value
+        self._state_key = tuple(sorted((n, repr(v)) for n, v in self._state.items()))
+
+    @property
+    def delta(self):
+        return getattr(self.estimator, 'delta', False)
+
+    def fit(self, graphs):
+        self.estimator.fit(graphs)
+        self.cache.clear()
+        return self
+
+    def decision_function(self, graphs, parent=None):
+        keys = [(self._state_key, graph_key(g)) for g in graphs]
+        new = OrderedDict()
+        for key, graph in zip(keys, graphs):
+            if key in self.cache:
+                self.cache.move_to_end(key)
+            elif key not in new:
+                new[key] = graph
+        self.misses += len(new)
+        self.hits += len(keys) - len(new)
+        if new:
+            if parent is None:
+                scores = self.estimator.decision_function(list(new.values()))
+            else:
+                scores = self.estimator.decision_function(list(new.values()), parent=parent)
+            self.cache.update(zip(new, scores))
+        result = np.array([self.cache[key] for key in keys])
+        while len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+        return result
+
+
+def graph_key(graph):
+    '''hash of a labeled graph, equal for isomorphic graphs'''
+    label = lambda id, node: (node.get('edge', False), node.get('label'))
+    return lcip.graph_hash(lcip._edge_to_vertex(graph), get_node_label=label)
+
+
 class RandomEstimator():
     def __init__(self):
         pass
@@ -7,11 +7,11 @@ import graphlearn.lsgg_core_interface_pair as cip
 
 class StructurePreservingCIP(cip.CoreInterfacePair): 
   
-    def __init__(self,core,graph,thickness, preserve_ids=False):
+    def __init__(self,core,graph,thickness, preserve_ids=False, context=None):
         '''core structure does not change..'''
 
 
-        super(StructurePreservingCIP,self).__init__(core,graph,thickness)
+        super(StructurePreservingCIP,self).__init__(core,graph,thickness, context)
 
         structhash = cip.graph_hash(core, get_node_label= lambda i,n: i if preserve_ids else 0)
         self.interface_hash= hash((self.interface_hash,structhash)) 
@@ -22,6 +22,11 @@ class StructurePreservingGrammar(lsgg):
         super(StructurePreservingGrammar,self).__init__(**kwargs)
         self.preserve_ids= preserve_ids
 
-    def _get_cip(self, core=None, graph=None):
+    def _get_cip(self, core=None, graph=None, context=None):
         return StructurePreservingCIP(core=core, graph=graph, thickness=self.thickness, 
-                preserve_ids=self.preserve_ids)
+                preserve_ids=self.preserve_ids, context=context)
+
+    def _get_interface_hash(self, core=None, graph=None, context=None):
+        interface_hash = cip.cip_interface_hash(core, self.thickness, context)
+        structhash = cip.graph_hash(core, get_node_label= lambda i,n: i if self.preserve_ids else 0)
+        return hash((interface_hash,structhash))
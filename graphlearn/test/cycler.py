@@ -2,6 +2,7 @@ import networkx as nx
 import collections
 import graphlearn.test.transformutil as util
 import graphlearn.lsgg_core_interface_pair
+from graphlearn.util.graphhash import stable_hash
 
 
 
@@ -11,7 +12,7 @@ import graphlearn.lsgg_core_interface_pair
 class Cycler():
 
     def _compute_cycle_node_name(self, g, cycle):
-        return cycle, hash( tuple(sorted( [g.nodes[n]['label'] for n in cycle] ))) , hash( tuple(sorted(cycle) ))
+        return cycle, stable_hash( tuple(sorted( [g.nodes[n]['label'] for n in cycle] ))) , hash( tuple(sorted(cycle) ))
 
     def _merge(self, graph, cycle_name_id):
         cycle, name,idd = cycle_name_id
@@ -0,0 +1,32 @@
+"""a fitted sampling grammar and samplers on it, shared by the tests"""
+
+from graphlearn.util import util
+from graphlearn.sample import LocalSubstitutionGraphGrammarSample, Sampler
+from graphlearn.score import RandomEstimator
+from graphlearn.choice import SelectMax
+from graphlearn.test.transformutil import no_transform
+
+
+def get_grammar(graphs=None, **kwargs):
+    """LocalSubstitutionGraphGrammarSample fitted on graphs (default: util.get_cyclegraphs())"""
+    args = dict(filter_min_cip=1, filter_min_interface=1)
+    args.update(kwargs)
+    return LocalSubstitutionGraphGrammarSample(**args).fit(graphs or util.get_cyclegraphs())
+
+
+def get_sampler(grammar, **kwargs):
+    """Sampler with a random scorer, SelectMax and no transformation, kwargs overwrite these"""
+    args = dict(grammar=grammar, scorer=RandomEstimator(), selector=SelectMax(), transformer=no_transform())
+    args.update(kwargs)
+    return Sampler(**args)
+
+
+class LengthScorer(RandomEstimator):
+    """scores a graph by its number of nodes, remembers the sizes of the batches it scored"""
+
+    def __init__(self):
+        self.calls = []
+
+    def decision_function(self, graphs, parent=None):
+        self.calls.append(len(graphs))
+        return [float(len(g)) for g in graphs]
@@ -0,0 +1,24 @@
+from graphlearn.util import benchmark
+
+
+def test_benchmark(tmpdir):
+    for kind in benchmark.GENERATORS:
+        assert all(len(g) >= 30 for g in benchmark.make_graphs(kind, 30, 3))
+    result = benchmark.run(operations=['graph_hash', 'substitute_core'], sizes=[15], n_graphs=2, repeat=1)
+    assert sorted(result['results']) == ['graph_hash/cyclic/15', 'graph_hash/molecule/15',
+                                         'substitute_core/cyclic/15', 'substitute_core/molecule/15']
+    path = str(tmpdir.join('run.json'))
+    benchmark.save(result, path)
+    baseline = benchmark.load(path)
+    assert benchmark.compare(result, baseline) == []
+    baseline['results']['graph_hash/cyclic/15'] /= 2
+    assert [key for key, old, new, ratio in benchmark.compare(result, baseline)] == ['graph_hash/cyclic/15']
+
+
+def test_benchmark_fit_parallel():
+    graphs = benchmark.make_graphs('cyclic', 15, 2)
+    fit = benchmark.setup('fit_parallel', graphs)
+    first, second = fit(), fit()
+    assert first is not second
+    assert first.size() == second.size() == benchmark._grammar(graphs).size()
+    assert sum(len(cips) for cips in benchmark.setup('cip', graphs)()) > 0
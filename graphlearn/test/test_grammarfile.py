@@ -0,0 +1,29 @@
+import pickle
+import pytest
+from graphlearn import LSGG
+from graphlearn.util import util
+from graphlearn.util import grammarfile
+
+
+def test_grammarfile(tmpdir):
+    graphs = util.get_cyclegraphs()
+    lsgg = LSGG(filter_min_cip=1, filter_min_interface=1).fit(graphs)
+    path = str(tmpdir.join('grammar'))
+    grammarfile.save(lsgg, path)
+    loaded = grammarfile.load(path, max_interfaces=2)
+    assert loaded.size() == lsgg.size()
+    assert len(loaded.productions._cache) == 2
+    assert loaded.thickness == lsgg.thickness
+    graph = graphs[3]
+    assert len(list(loaded.neighbors(graph))) == len(list(lsgg.neighbors(graph)))
+    assert pickle.loads(pickle.dumps(loaded)).size() == lsgg.size()
+
+
+def test_grammarfile_read_only(tmpdir):
+    graphs = util.get_cyclegraphs()
+    path = str(tmpdir.join('grammar'))
+    grammarfile.save(LSGG(filter_min_cip=1, filter_min_interface=1).fit(graphs), path)
+    loaded = grammarfile.load(path)
+    for fit in (loaded.fit, loaded.partial_fit, lambda graphs: loaded.fit(graphs, n_jobs=2)):
+        with pytest.raises(ValueError, match='read only'):
+            fit(graphs)
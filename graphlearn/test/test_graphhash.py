@@ -0,0 +1,98 @@
+from graphlearn import lsgg_core_interface_pair as cip
+from graphlearn.util import util
+from graphlearn.util import graphhash
+from graphlearn.test import sampleutil
+import networkx as nx
+import numpy as np
+import os
+import pickle
+import pytest
+import random
+import subprocess
+import sys
+
+
+def _cores():
+    cores = []
+    for g in util.get_cyclegraphs():
+        for core in cip.get_cores(g, [0, 2, 4]):
+            core = nx.Graph(core)
+            cip._add_hlabel(core)
+            cores.append(core)
+    # whole graphs, some of them above SMALL_GRAPH
+    graphs = util.get_cyclegraphs()
+    for k in range(1, len(graphs) + 1):
+        for union in (nx.disjoint_union_all(graphs[:k]), nx.disjoint_union_all(graphs[:k][::-1])):
+            union = cip._edge_to_vertex(union)
+            cip._add_hlabel(union)
+            cores.append(union)
+    return cores
+
+
+def test_engines_agree():
+    # both engines must partition the cores into the same equivalence classes
+    cores = _cores()
+    ref = [cip.graph_hash(c, engine='reference') for c in cores]
+    fast = [cip.graph_hash(c, engine='numpy') for c in cores]
+    for i in range(len(cores)):
+        for j in range(len(cores)):
+            assert (ref[i] == ref[j]) == (fast[i] == fast[j])
+
+
+def test_hash_ignores_node_ids():
+    g = cip._edge_to_vertex(util.test_get_circular_graph())
+    cip._add_hlabel(g)
+    ids = list(g.nodes())
+    random.shuffle(ids)
+    h = nx.relabel_nodes(g, dict(zip(g.nodes(), ids)))
+    assert cip.graph_hash(g) == cip.graph_hash(h)
+    g.nodes[0]['hlabel'] += 1
+    assert cip.graph_hash(g) != cip.graph_hash(h)
+
+
+def test_one_dispatch():
+    # both entry points give the same value, below and above SMALL_GRAPH
+    cores = _cores()
+    assert min(map(len, cores)) < graphhash.SMALL_GRAPH <= max(map(len, cores))
+    assert [cip.graph_hash(c) for c in cores] == [graphhash.graph_hash(c) for c in cores]
+
+
+
+def test_stable_hash_numpy_scalars():
+    # labels built from numpy values hash as the same python values
+    assert graphhash.stable_hash((np.int64(1), 2)) == graphhash.stable_hash((1, 2))
+    assert graphhash.stable_hash([np.float64(.5), ('a', np.int32(3))]) == graphhash.stable_hash([.5, ('a', 3)])
+    assert graphhash.stable_hash(np.str_('C')) == graphhash.stable_hash('C')
+    assert graphhash.stable_hash((1, 2)) != graphhash.stable_hash((2, 1))
+
+
+def test_stable_hashes():
+    # string labels give the same hashes under any PYTHONHASHSEED
+    script = ('from graphlearn.util import util\n'
+              'from graphlearn.score import graph_key\n'
+              'from graphlearn.test.cycler import Cycler\n'
+              'graphs = util.get_cyclegraphs()\n'
+              'lsgg = util.test_get_grammar()\n'
+              'cycles = [Cycler()._compute_cycle_node_name(graphs[0], [0, 1, 2])[1]]\n'
+              'print(sorted((i, sorted(c)) for i, c in lsgg.productions.items()), graph_key(graphs[0]), cycles)\n')
+    outputs = set()
+    for seed in ['1', '2']:
+        env = dict(os.environ, PYTHONHASHSEED=seed)
+        outputs.add(subprocess.check_output([sys.executable, '-c', script], env=env))
+    assert len(outputs) == 1
+
+
+def test_hash_scheme():
+    # a grammar pickled before the hash scheme was recorded has to be refit
+    graphs = util.get_cyclegraphs()
+    lsgg = sampleutil.get_grammar(graphs)
+    assert len(list(lsgg.neighbors(graphs[3]))) > 0
+    del lsgg.hash_scheme
+    old = pickle.loads(pickle.dumps(lsgg))
+    with pytest.raises(ValueError, match='refit required'):
+        list(old.neighbors(graphs[3]))
+    with pytest.raises(ValueError, match='refit required'):
+        list(old.neighbors_sample(graphs[3], 1))
+    with pytest.raises(ValueError, match='refit required'):
+        old.fit(graphs)
+    assert sampleutil.get_grammar(graphs).hash_scheme == cip.hash_scheme()
@@ -6,8 +6,17 @@
 #from graphlearn import local_substitution_graph_grammar as lsgg
 
 
+import json
 import logging
+import os
+import pickle
+import random
+import pytest
 from graphlearn.util import util
+from graphlearn import LSGG
+from graphlearn.choice import SelectMaxN
+from graphlearn import lsgg_core_interface_pair as lcip
+from graphlearn.test import sampleutil
 import networkx as nx
 
 import sys
@@ -86,3 +95,296 @@ def visualize_test_pathgraphs_thin_interface():
     print("APPLYING ALL PRODUCTIONS:")
     so.gprint(list(lsgg.neighbors(g)))
 
+
+
+def _counts(lsgg):
+    return {(i, c): cip.count for i, v in lsgg.productions.items() for c, cip in v.items()}
+
+
+def test_decomposition_context():
+    g = util.test_get_circular_graph()
+    context = lcip.DecompositionContext(g)
+    cores = list(lcip.get_cores(g, [0, 2, 4], context))
+    # every core node set is produced once
+    assert len({frozenset(c) for c in cores}) == len(cores)
+    # sharing the context changes nothing about the cips
+    shared = [lcip.CoreInterfacePair(c, g, 2, context) for c in cores]
+    alone = [lcip.CoreInterfacePair(c, g, 2) for c in cores]
+    assert [(a.core_hash, a.interface_hash) for a in shared] == \
+           [(b.core_hash, b.interface_hash) for b in alone]
+
+
+def test_root_cores_distances():
+    # the distances get_cores derives from the root bfs equal a bfs from the core
+    for g in util.get_cyclegraphs():
+        context = lcip.DecompositionContext(g)
+        for core in lcip.get_cores(g, [0, 1, 2, 3], context, thickness=2):
+            bfs = dict(lcip.short_paths(context.exgraph, core.nodes(), 2))
+            assert context.core_distances(core.nodes(), 2) == bfs
+
+
+def test_fit_streaming():
+    graphs = util.get_cyclegraphs() * 3
+    serial = LSGG(filter_min_cip=1).fit(graphs)
+    streamed = LSGG(filter_min_cip=1).fit((g for g in graphs), n_jobs=2, batch_size=4)
+    assert serial.size() == streamed.size()
+
+
+def test_fit_mapreduce():
+    # partial grammars are merged before filtering, the counts are exact
+    graphs = util.get_cyclegraphs() * 2
+    serial = LSGG(filter_min_cip=3).fit(graphs)
+    parallel = LSGG(filter_min_cip=3).fit(graphs, n_jobs=3, chunksize=2)
+    assert _counts(serial) == _counts(parallel)
+
+
+def test_frozen_cip():
+    import pickle
+    graphs = util.get_cyclegraphs()
+    lsgg = LSGG(filter_min_cip=1, filter_min_interface=1).fit(graphs)
+    stored = [c for v in lsgg.productions.values() for c in v.values()]
+    for c in stored:
+        assert set(c.interface.nodes()) | set(c.core_nodes) <= set(c.graph.nodes())
+    # a stored cip is detached from its source graph
+    cip = next(lsgg._get_cips(graphs[3]))
+    assert len(pickle.dumps(cip.freeze())) < len(pickle.dumps(cip))
+    with pytest.raises(AttributeError):
+        stored[0].core_hash = 0
+    stored[0].count += 1
+    assert len(list(lsgg.neighbors(graphs[0]))) > 0
+
+
+def test_fit_twopass():
+    graphs = util.get_cyclegraphs() * 2
+    args = dict(filter_min_cip=2, filter_max_num_substitutions=2)
+    onepass = LSGG(**args).fit(graphs)
+    assert _counts(onepass) == _counts(LSGG(**args).fit(graphs, twopass=True))
+    assert _counts(onepass) == _counts(LSGG(**args).fit(graphs, n_jobs=2, chunksize=3, twopass=True))
+    with pytest.raises(ValueError):
+        LSGG().fit(iter(graphs), twopass=True)
+
+
+def test_partial_fit():
+    graphs = util.get_cyclegraphs() * 2
+    lsgg = LSGG().partial_fit(graphs[:5]).partial_fit(graphs[5:], n_jobs=2, chunksize=2)
+    assert _counts(lsgg) == _counts(LSGG().fit(graphs))
+    lsgg.refilter(filter_min_cip=1, filter_min_interface=1)
+    assert _counts(lsgg) == _counts(LSGG(filter_min_cip=1, filter_min_interface=1).fit(graphs))
+    with pytest.raises(ValueError):
+        LSGG().fit(graphs).refilter(filter_min_cip=1)
+
+
+def test_partial_fit_then_fit():
+    # fit counts into copies, refilter still sees the counts of partial_fit
+    graphs = util.get_cyclegraphs()
+    for n_jobs in (1, 2):
+        lsgg = LSGG(filter_min_cip=1, filter_min_interface=1).partial_fit(graphs[:2])
+        raw = {(i, c): cip.count for i, cips in lsgg.raw_productions.items() for c, cip in cips.items()}
+        lsgg.fit(graphs, n_jobs=n_jobs)
+        assert {(i, c): cip.count for i, cips in lsgg.raw_productions.items() for c, cip in cips.items()} == raw
+        assert _counts(lsgg.refilter()) == _counts(LSGG(filter_min_cip=1, filter_min_interface=1).fit(graphs[:2]))
+
+
+
+def test_raw_productions_unpickled():
+    # grammars pickled before partial_fit existed have no raw counts
+    graphs = util.get_cyclegraphs()
+    lsgg = LSGG(filter_min_cip=1, filter_min_interface=1).fit(graphs)
+    del lsgg.raw_productions
+    old = pickle.loads(pickle.dumps(lsgg))
+    with pytest.raises(ValueError):
+        old.refilter(filter_min_cip=2)
+    args = dict(filter_min_cip=1, filter_min_interface=1)
+    assert _counts(pickle.loads(pickle.dumps(lsgg)).fit(graphs)) == _counts(LSGG(**args).fit(graphs * 2))
+    assert _counts(old.partial_fit(graphs)) == _counts(LSGG(**args).fit(graphs))
+
+
+def test_canonical_interface():
+    g = util.test_get_circular_graph()
+    for core in lcip.get_cores(g, [0, 2]):
+        cip = lcip.CoreInterfacePair(core, g, 2)
+        ids = list(cip.interface.nodes())
+        random.shuffle(ids)
+        shuffled = nx.relabel_nodes(cip.interface, dict(zip(cip.interface.nodes(), ids)))
+        nodes, form = lcip.canonical_interface(shuffled)
+        assert form == cip.canonical()[1]
+        mapping = dict(zip(nodes, cip.canonical()[0]))
+        assert all(cip.interface.has_edge(mapping[a], mapping[b]) for a, b in shuffled.edges())
+        assert all(cip.interface.nodes[mapping[n]]['ilabel'] == d['ilabel'] for n, d in shuffled.nodes(data=True))
+
+
+def test_applicable_cores():
+    graphs = util.get_cyclegraphs()
+    lsgg = sampleutil.get_grammar(graphs, filter_min_interface=2)
+    for graph, roots in zip(graphs, lsgg.applicable_cores(graphs)):
+        context = lsgg._get_context(graph)
+        list(lsgg._get_cores(graph, context))
+        cores = [context.core(root, radius) for root, radius in roots]
+        assert all(radius in lsgg.radii for root, radius in roots)
+        assert all(root in core for (root, radius), core in zip(roots, cores))
+        cips = [lsgg._get_cip(core, graph) for core in cores]
+        assert all(cip.interface_hash in lsgg.productions for cip in cips)
+        assert len(cores) == sum(1 for cip in lsgg._get_cips(graph) if cip.interface_hash in lsgg.productions)
+    assert len(list(lsgg.neighbors_sample(graphs[3], 2))) == 2
+
+
+
+def test_applicable_cores_unindexed():
+    # grammars pickled before the index existed build it on first use
+    graphs = util.get_cyclegraphs()
+    lsgg = sampleutil.get_grammar(graphs, filter_min_interface=2)
+    expected = lsgg.applicable_cores(graphs)
+    del lsgg._interface_index
+    lsgg = pickle.loads(pickle.dumps(lsgg))
+    assert lsgg.applicable_cores(graphs) == expected
+    assert lsgg._interface_index == frozenset(lsgg.productions)
+    assert len(list(lsgg.neighbors_sample(graphs[3], 2))) == 2
+
+
+
+def test_index_follows_productions():
+    # productions changed without a refilter are found by the index
+    graphs = util.get_cyclegraphs()
+    lsgg = sampleutil.get_grammar(graphs[:1])
+    assert not all(lsgg._has_interface(cip.interface_hash) for cip in lsgg._get_cips(graphs[1]))
+    lsgg._merge_productions(lsgg._make_productions(graphs[1:2]))
+    assert all(lsgg._has_interface(cip.interface_hash) for cip in lsgg._get_cips(graphs[1]))
+    lsgg._store_graph(graphs[2])
+    assert all(lsgg._has_interface(cip.interface_hash) for cip in lsgg._get_cips(graphs[2]))
+    with pytest.raises(ValueError):
+        lsgg._get_context(graphs[0]).core(0, 0)
+
+
+class FragmentGrammar(sampleutil.LocalSubstitutionGraphGrammarSample):
+    """cores that are not grown around a root, like those of lsgg_ego"""
+
+    def _get_cores(self, graph, context=None):
+        exgraph = context.exgraph if context else lcip._edge_to_vertex(graph)
+        return [exgraph.subgraph(nx.single_source_shortest_path_length(exgraph, n, 2)) for n in exgraph
+                if 'edge' not in exgraph.nodes[n]]
+
+
+def test_applicable_cores_without_roots():
+    graphs = util.get_cyclegraphs()
+    lsgg = FragmentGrammar(filter_min_cip=1, filter_min_interface=1).fit(graphs)
+    cores = lsgg.applicable_cores(graphs)[0]
+    assert cores and all(isinstance(core, nx.Graph) for core in cores)
+    random.seed(1)
+    assert len(list(lsgg.neighbors_sample(graphs[0], 2))) > 0
+
+
+def test_core_hash_only_for_hits():
+    graphs = util.get_cyclegraphs()
+    lsgg = sampleutil.get_grammar(graphs[:1], filter_min_interface=2)
+    hashed = []
+    core_hash = lsgg._get_core_hash
+    lsgg._get_core_hash = lambda core=None, **kwargs: hashed.append(core) or core_hash(core=core, **kwargs)
+    context = lsgg._get_context(graphs[3])
+    n_cores = len(list(lsgg._get_cores(graphs[3], context)))
+    roots = list(lsgg._applicable_cores(graphs[3], context))
+    assert len(hashed) == len(roots) < n_cores
+
+
+def test_cip_reuses_hashes(monkeypatch):
+    graphs = util.get_cyclegraphs()
+    lsgg = sampleutil.get_grammar(graphs, filter_min_interface=2)
+    context = lsgg._get_context(graphs[0])
+    roots = list(lsgg._applicable_cores(graphs[0], context))
+    expected = [lsgg._get_cip(context.core(root, radius), graphs[0]) for root, radius in roots]
+    monkeypatch.setattr(lcip, 'graph_hash', None)
+    cips = [lsgg._get_cip(context.core(root, radius), graphs[0], context) for root, radius in roots]
+    assert [(c.interface_hash, c.core_hash) for c in cips] == [(c.interface_hash, c.core_hash) for c in expected]
+
+
+def test_working_graph():
+    graphs = util.get_cyclegraphs()
+    lsgg = sampleutil.get_grammar(graphs, filter_min_interface=2)
+    match = lambda a, b: a.get('label') == b.get('label')
+    work = lcip.WorkingGraph(graphs[0])
+    before = nx.Graph(work.exgraph)
+    for cip, congruent_cip in list(lsgg.substitutions_sample(work.exgraph)):
+        assert work.substitute(cip, congruent_cip)
+        expected = lcip.substitute_core(graphs[0], cip, congruent_cip)
+        assert nx.is_isomorphic(work.graph(), expected, node_match=match, edge_match=match)
+        work.undo()
+        assert nx.utils.graphs_equal(work.exgraph, before)
+
+    sampler = sampleutil.get_sampler(lsgg, n_steps=5, inplace=True, num_sample=3)
+    assert len(sampler.sample(graphs[0])) > 0
+    sampler = sampleutil.get_sampler(lsgg, n_steps=5, inplace=True, num_sample=3, selector=SelectMaxN(2))
+    with pytest.raises(ValueError):
+        sampler.sample(graphs[0])
+
+
+def test_incremental_context():
+    # after in place substitutions the updated context knows the same cores as a new one
+    graphs = util.get_cyclegraphs()
+    lsgg = sampleutil.get_grammar(graphs)
+    state = lambda context: {frozenset(core.nodes()): context.hashes[frozenset(core.nodes())]
+                             for core in lsgg._get_cores(context.exgraph, context)}
+    random.seed(2)
+    for graph in graphs:
+        work = lcip.WorkingGraph(graph)
+        context = lsgg._get_context(work.exgraph)
+        for step in range(4):
+            list(lsgg._applicable_cores(work.exgraph, context))
+            substitutions = list(lsgg.substitutions_sample(work.exgraph, context))
+            if not substitutions:
+                break
+            work.substitute(*random.choice(substitutions))
+            lsgg._update_context(context, *work.changes())
+            work.commit()
+            fresh = lsgg._get_context(work.exgraph)
+            list(lsgg._applicable_cores(work.exgraph, fresh))
+            list(lsgg._applicable_cores(work.exgraph, context))
+            assert state(context) == state(fresh)
+
+
+def test_grammar_stats_parallel():
+    # the workers count too, their stats are merged into those of the grammar
+    graphs = util.get_cyclegraphs()
+    serial = LSGG(filter_min_cip=1, filter_min_interface=1)
+    stats = serial.collect_stats()
+    serial.fit(graphs)
+    for twopass in (False, True):
+        lsgg = LSGG(filter_min_cip=1, filter_min_interface=1)
+        parallel = lsgg.collect_stats()
+        lsgg.fit(graphs, n_jobs=2, chunksize=1, twopass=twopass)
+        assert parallel.counts['cores'] == stats.counts['cores'] * (1 + twopass) > 0
+        assert parallel.calls['cip'] == stats.calls['cip']
+        assert parallel.seconds['decompose'] > 0
+
+
+def test_grammar_stats():
+    graphs = util.get_cyclegraphs()
+    lsgg = sampleutil.LocalSubstitutionGraphGrammarSample(filter_min_cip=1, filter_min_interface=1)
+    assert lsgg.stats is None
+    stats = lsgg.collect_stats()
+    lsgg.fit(graphs)
+    assert stats.counts['cores'] > 0 and stats.calls['cip'] == stats.counts['cores']
+    neighbors = list(lsgg.neighbors(graphs[0]))
+    assert stats.counts['congruent_cips'] == stats.calls['substitute'] >= len(neighbors) > 0
+    assert stats.counts['failed_substitutions'] == stats.calls['substitute'] - len(neighbors)
+    cips = list(lsgg._get_cips(graphs[1]))
+    a, b = next((a, b) for a in cips for b in cips if len(a.interface) != len(b.interface))
+    assert lsgg._substitute(graphs[1], a, b) is None
+    assert stats.counts['failed_substitutions'] == stats.calls['substitute'] - len(neighbors)
+    interface, worst = stats.costly_interfaces(1)[0]
+    assert worst['seconds'] == max(s['seconds'] for s in stats.interfaces.values())
+    assert str(interface) in stats.report()
+    lsgg.stats = None
+    list(lsgg.neighbors(graphs[0]))
+    assert stats.calls['substitute'] == len(neighbors) + stats.counts['failed_substitutions']
+
+
+def test_fit_counts_distinct_cores():
+    # a core node set reached from several roots or radii is counted once per graph.
+    # before the cores were deduplicated, the same fit gave (52, 115, 284, 3396) and 2259
+    with open(os.path.join(os.path.dirname(__file__), 'chemtest.json')) as f:
+        graphs = [nx.readwrite.node_link_graph(x, edges='links') for x in json.load(f)[:30]]
+    lsgg = LSGG(radii=[0, 1, 2], thickness=1, filter_min_cip=2, filter_min_interface=2).fit(graphs)
+    assert lsgg.size() == (51, 97, 237, 2154)
+    assert sum(_counts(lsgg).values()) == 1968
+    for graph in graphs[:5]:
+        cores = [frozenset(core) for core in lcip.get_cores(graph, [0, 1, 2])]
+        assert len(cores) == len(set(cores))
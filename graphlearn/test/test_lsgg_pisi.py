@@ -0,0 +1,76 @@
+import os
+import subprocess
+import sys
+import numpy as np
+import scipy.sparse as sparse
+from graphlearn import lsgg_pisi
+from graphlearn.util import util
+from graphlearn.util import grammarfile
+
+
+def _cip_rows(grammar):
+    return sorted(len(cip.pisi_rows) for cips in grammar.productions.values() for cip in cips.values())
+
+
+def test_pisi_congruent_cips():
+    graphs = util.get_cyclegraphs()
+    grammar = lsgg_pisi.PiSi(thickness_pisi=2, filter_min_cip=1, filter_min_interface=1).fit(graphs)
+    merged = lsgg_pisi.PiSi(thickness_pisi=2, filter_min_cip=1, filter_min_interface=1)
+    merged._merge_productions(grammar._make_productions(graphs[:2]))
+    merged._merge_productions(grammar._make_productions(graphs[2:]))
+    merged._filter_cips()
+    assert _cip_rows(grammar) == _cip_rows(merged)
+    n = 0
+    for cip in grammar._get_cips(graphs[0]):
+        congruent = [(c.core_hash, c.pisisimilarity) for c in grammar._get_congruent_cips(cip)]
+        # the similarity of each congruent cip on its own
+        expected = [(c.core_hash, sparse.vstack(c.pisi_vectors).dot(cip.pisi_vectors.T).toarray().max())
+                    for c in grammar.productions.get(cip.interface_hash, {}).values()
+                    if c.core_hash != cip.core_hash]
+        expected = [(core, s) for core, s in expected if s > 0]
+        assert [core for core, s in congruent] == [core for core, s in expected]
+        assert np.allclose([s for core, s in congruent], [s for core, s in expected])
+        n += len(congruent)
+    assert n > 0
+    assert len(list(grammar.neighbors(graphs[0]))) > 0
+
+
+
+def test_pisi_stats():
+    # PiSi yields its congruent cips, the stats count them all the same
+    graphs = util.get_cyclegraphs()
+    grammar = lsgg_pisi.PiSi(thickness_pisi=2, filter_min_cip=1, filter_min_interface=1)
+    stats = grammar.collect_stats()
+    grammar.fit(graphs)
+    neighbors = list(grammar.neighbors(graphs[0]))
+    assert stats.counts['congruent_cips'] == stats.calls['substitute'] >= len(neighbors) > 0
+    assert len(list(grammar.neighbors_sample(graphs[0], 2))) > 0
+    assert stats.calls['congruent'] > 0
+
+
+def test_pisi_vectors_stable():
+    # the stored vectors are in the same feature space under any PYTHONHASHSEED
+    script = ('from graphlearn import lsgg_pisi\n'
+              'from graphlearn.util import util\n'
+              'grammar = lsgg_pisi.PiSi(thickness_pisi=2, filter_min_cip=1, filter_min_interface=1)\n'
+              'grammar.fit(util.get_cyclegraphs())\n'
+              'print(sorted((i, c, lsgg_pisi._finalize(cip).indices.tolist())\n'
+              '             for i, cips in grammar.productions.items() for c, cip in cips.items()))\n')
+    outputs = set()
+    for seed in ['1', '2']:
+        env = dict(os.environ, PYTHONHASHSEED=seed)
+        outputs.add(subprocess.check_output([sys.executable, '-c', script], env=env))
+    assert len(outputs) == 1
+
+
+def test_pisi_index_bounded(tmpdir):
+    graphs = util.get_cyclegraphs()
+    path = str(tmpdir.join('pisi.gram'))
+    grammarfile.save(lsgg_pisi.PiSi(thickness_pisi=2, filter_min_cip=1, filter_min_interface=1).fit(graphs), path)
+    grammar = grammarfile.load(path, max_interfaces=2)
+    assert len(grammar.productions) > 2
+    for graph in graphs:
+        for cip in grammar._get_cips(graph):
+            list(grammar._get_congruent_cips(cip))
+            assert len(grammar._pisi_index) <= 2
+    assert list(grammar._pisi_index)[-1] == cip.interface_hash
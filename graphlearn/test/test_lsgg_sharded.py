@@ -0,0 +1,72 @@
+import networkx as nx
+import pytest
+from graphlearn import LSGG
+from graphlearn.lsgg_sharded import ShardedGrammar
+from graphlearn.sample import ParallelSampler
+from graphlearn.test import sampleutil
+from graphlearn.util import util
+
+
+def test_sharded_grammar():
+    graphs = util.get_cyclegraphs() * 2
+    lsgg = LSGG().fit(graphs)
+    sharded = ShardedGrammar(n_shards=3).fit(graphs, n_jobs=2, chunksize=2)
+    try:
+        assert sharded.size() == lsgg.size()
+        assert set(sharded.productions) == set(lsgg.productions)
+        graph = graphs[3]
+        assert len(list(sharded.neighbors(graph))) == len(list(lsgg.neighbors(graph)))
+    finally:
+        sharded.close()
+
+
+def test_sharded_parallel_sampler():
+    # forked chains use connections of their own, each gets the replies to its requests
+    graphs = util.get_cyclegraphs() * 3
+    lsgg = sampleutil.get_grammar(graphs)
+    sharded = ShardedGrammar(n_shards=2, filter_min_cip=1, filter_min_interface=1).fit(graphs)
+    try:
+        sample = lambda grammar, n_jobs: dict(ParallelSampler(
+            sampleutil.get_sampler(grammar, n_steps=6, num_sample=3), n_jobs=n_jobs, seed=1).sample(graphs))
+        expected = sample(lsgg, 1)
+        chains = sample(sharded, 4)
+        assert sorted(chains) == sorted(expected)
+        assert all(nx.utils.graphs_equal(expected[i], chains[i]) for i in expected)
+        assert len(list(sharded.neighbors(graphs[3]))) == len(list(lsgg.neighbors(graphs[3])))
+    finally:
+        sharded.close()
+
+
+def test_sharded_partial_fit():
+    graphs = util.get_cyclegraphs()
+    lsgg = LSGG(filter_min_cip=2, filter_min_interface=1)
+    sharded = ShardedGrammar(n_shards=2, filter_min_cip=2, filter_min_interface=1)
+    try:
+        with pytest.raises(ValueError):
+            sharded.refilter()
+        for part in (graphs[:2], graphs[2:]):
+            lsgg.partial_fit(part)
+            sharded.partial_fit(part, n_jobs=2, chunksize=1)
+            assert sharded.size() == lsgg.size()
+        assert sharded.refilter(filter_min_cip=1).size() == lsgg.refilter(filter_min_cip=1).size()
+        assert sharded.filter_min_cip == 1
+        assert len(list(sharded.neighbors(graphs[3]))) == len(list(lsgg.neighbors(graphs[3])))
+        with pytest.raises(TypeError):
+            sharded.refilter(radii=[0])
+        assert sharded.size() == lsgg.size()
+    finally:
+        sharded.close()
+
+
+def test_sharded_twopass():
+    graphs = util.get_cyclegraphs() * 2
+    lsgg = LSGG().fit(graphs, twopass=True)
+    for n_jobs in (1, 2):
+        sharded = ShardedGrammar(n_shards=3).fit(graphs, n_jobs=n_jobs, twopass=True, chunksize=2)
+        try:
+            assert sharded.size() == lsgg.size()
+            with pytest.raises(ValueError):
+                sharded.refilter()
+            assert sharded.size() == lsgg.size()
+        finally:
+            sharded.close()
@@ -0,0 +1,72 @@
+import functools
+import glob
+import operator
+import os
+import tempfile
+import networkx as nx
+import numpy as np
+from eden.graph import Vectorizer
+from graphlearn.util import util
+from graphlearn.util.multi import WorkerPool
+from graphlearn.score import OneClassEstimator
+from graphlearn.sample import ParallelSampler
+from graphlearn.test import sampleutil
+
+
+def test_worker_pool():
+    with WorkerPool(2, add=functools.partial(operator.add, 10)) as pool:
+        assert pool.map('add', range(5)) == [10, 11, 12, 13, 14]
+        assert sorted(pool.imap(abs, [-1, -2, 3])) == [1, 2, 3]
+        assert pool.chunksize(list(range(100))) == 13
+
+
+def test_estimator_pool():
+    graphs = util.get_cyclegraphs()
+    estimator = OneClassEstimator(n_jobs=2).fit(graphs)
+    pool = estimator.pool
+    for i in range(2):
+        assert (estimator.transform(graphs) != Vectorizer().transform(graphs)).nnz == 0
+    assert estimator.pool is pool
+    pool.close()
+
+
+def test_worker_pool_resident_per_call():
+    with WorkerPool(1, add=functools.partial(operator.add, 10)) as pool:
+        assert pool.map('sub', [1, 2], resident={'sub': functools.partial(operator.sub, 5)}) == [4, 3]
+        assert list(pool.imap('add', [1, 2], resident={'add': functools.partial(operator.add, 1)})) == [2, 3]
+        assert pool.map('add', [1]) == [11]
+    assert not glob.glob(tempfile.gettempdir() + '/workerpool-*')
+
+
+def _touch(directory, i):
+    open(os.path.join(directory, str(i)), 'w').close()
+    return i
+
+
+def test_worker_pool_abandoned_imap(tmpdir):
+    # the tasks that are queued when the consumer stops still find the resident file
+    with WorkerPool(2) as pool:
+        results = pool.imap('touch', range(20), buffersize=10,
+                            resident={'touch': functools.partial(_touch, str(tmpdir))})
+        next(results)
+        results.close()
+        assert len(tmpdir.listdir()) == 20
+        assert not glob.glob(tempfile.gettempdir() + '/workerpool-*')
+
+
+def test_shared_pool():
+    graphs = util.get_cyclegraphs()
+    with WorkerPool(2) as pool:
+        grammar = sampleutil.get_grammar(graphs[:1])
+        assert grammar.fit(graphs, pool=pool).size() == sampleutil.get_grammar(graphs).size()
+        grammar.raw_productions = None
+        grammar.partial_fit(graphs[:2], pool=pool).partial_fit(graphs[2:], pool=pool)
+        sampler = sampleutil.get_sampler(grammar, n_steps=2)
+        shared = dict(ParallelSampler(sampler, seed=3, pool=pool).sample(graphs))
+        estimator = OneClassEstimator(pool=pool).fit(graphs)
+        assert (estimator.transform(graphs) != Vectorizer().transform(graphs)).nnz == 0
+        assert np.allclose(estimator.decision_function(graphs), OneClassEstimator().fit(graphs).decision_function(graphs))
+    reference = sampleutil.get_grammar(graphs)
+    assert grammar.size() == reference.size()
+    serial = dict(ParallelSampler(sampler, n_jobs=1, seed=3).sample(graphs))
+    assert all(nx.utils.graphs_equal(serial[i], shared[i]) for i in serial)
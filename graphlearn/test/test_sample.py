@@ -0,0 +1,102 @@
+import random
+import numpy as np
+import networkx as nx
+from graphlearn.util import util
+from graphlearn.sample import ParallelSampler
+from graphlearn.test import sampleutil
+from graphlearn.test.sampleutil import LengthScorer
+
+
+def test_sample_step_multi_batches():
+    graphs = util.get_cyclegraphs()
+    scorer = LengthScorer()
+    sampler = sampleutil.get_sampler(sampleutil.get_grammar(graphs), scorer=scorer, num_sample=5, batch_size=2)
+    best, score = sampler.sample_step_multi(graphs[0], 0)
+    n_proposals = sum(scorer.calls[1:])
+    assert scorer.calls[1:] == [2] * (n_proposals // 2) + [1] * (n_proposals % 2)
+    assert score == len(best)
+
+
+def test_parallel_sampler():
+    graphs = util.get_cyclegraphs()
+    sampler = sampleutil.get_sampler(sampleutil.get_grammar(graphs), n_steps=4)
+    serial = dict(ParallelSampler(sampler, n_jobs=1, seed=3).sample(graphs))
+    parallel = dict(ParallelSampler(sampler, n_jobs=2, seed=3).sample(graphs))
+    assert sorted(parallel) == list(range(len(graphs)))
+    assert all(nx.utils.graphs_equal(serial[i], parallel[i]) for i in serial)
+
+
+def test_sampler_checkpoint(tmpdir):
+    graphs = util.get_cyclegraphs()
+    lsgg = sampleutil.get_grammar(graphs)
+    path = str(tmpdir.join('chain'))
+    make = lambda n_steps: sampleutil.get_sampler(lsgg, n_steps=n_steps, burnin=1, emit=1, history_size=3,
+                                                  checkpoint=path, checkpoint_every=3)
+    random.seed(5)
+    np.random.seed(5)
+    sampler = make(7)
+    full = sampler.sample_burnin(graphs[2])
+    assert len(sampler.history) == 3
+    random.seed(5)
+    np.random.seed(5)
+    make(4).sample_burnin(graphs[2])  # killed after the checkpoint of step 3
+    random.seed(0)
+    resumed = make(7).resume()
+    assert len(resumed) == len(full) == 6
+    assert all(nx.utils.graphs_equal(a, b) for a, b in zip(full, resumed))
+
+
+def test_pipelined_sampler():
+    # the producer process makes the same proposals, the chain samples as without the pipeline
+    graphs = util.get_cyclegraphs()
+    lsgg = sampleutil.get_grammar(graphs)
+    results = []
+    for pipeline in [False, True]:
+        sampler = sampleutil.get_sampler(lsgg, scorer=LengthScorer(), num_sample=6, batch_size=2,
+                                         n_steps=4, pipeline=pipeline, pipeline_depth=1)
+        random.seed(4)
+        np.random.seed(4)
+        try:
+            steps = [sampler.sample_step(graphs[3], 0), sampler.sample_step_multi(graphs[3], 0),
+                     (sampler.sample(graphs[2]), None)]
+            results.append((steps, random.random(), np.random.random()))
+            assert (sampler._producer is not None) == pipeline
+        finally:
+            sampler.close()
+    (plain, *states), (pipelined, *pipelined_states) = results
+    assert states == pipelined_states
+    for (a, score_a), (b, score_b) in zip(plain, pipelined):
+        assert score_a == score_b and nx.utils.graphs_equal(a, b)
+
+
+
+def test_parallel_pipelined_sampler():
+    # the daemonic workers make the proposals of a pipelined chain themselves
+    graphs = util.get_cyclegraphs()
+    lsgg = sampleutil.get_grammar(graphs)
+    make = lambda pipeline: sampleutil.get_sampler(lsgg, scorer=LengthScorer(), n_steps=4, pipeline=pipeline)
+    plain = dict(ParallelSampler(make(False), n_jobs=1, seed=3).sample(graphs))
+    sampler = make(True)
+    pipelined = dict(ParallelSampler(sampler, n_jobs=2, seed=3).sample(graphs))
+    assert sorted(pipelined) == list(range(len(graphs)))
+    assert all(nx.utils.graphs_equal(plain[i], pipelined[i]) for i in plain)
+    assert sampler._producer is None
+
+
+def test_sample_step_backtrack():
+    graphs = util.get_cyclegraphs()
+    sampler = sampleutil.get_sampler(sampleutil.get_grammar(graphs), scorer=LengthScorer(), history_size=3)
+    graph = graphs[3]
+    for step in range(5):
+        graph, score = sampler.sample_step(graph, step)
+    assert len(sampler.history) == 3
+    entries = list(sampler.history)
+    # no production applies to these labels
+    dead = nx.path_graph(3)
+    nx.set_node_attributes(dead, 'x', 'label')
+    nx.set_edge_attributes(dead, 'x', 'label')
+    assert sampler.sample_step(dead, 5) is entries[1]
+    assert list(sampler.history) == entries[:1]
+    assert sampler.sample_step(dead, 6) == (None, 0)
+    assert sampleutil.get_sampler(None, backtrack_depth=4).history.maxlen == 8
+    assert sampleutil.get_sampler(None, backtrack_depth=4, history_size=None).history.maxlen is None
@@ -0,0 +1,67 @@
+import random
+import numpy as np
+import networkx as nx
+from eden.graph import Vectorizer
+from graphlearn.util import util
+from graphlearn.util.deltavec import DeltaVectorizer
+from graphlearn.score import CachedEstimator, OneClassAndSizeFactor, OneClassEstimator, graph_key
+from graphlearn.test import sampleutil
+from graphlearn.test.sampleutil import LengthScorer
+
+
+def test_delta_vectorizer():
+    # proposals vectorized relative to their parent get the vectors of a full transform
+    graphs = util.get_cyclegraphs()
+    lsgg = sampleutil.get_grammar(graphs)
+    vectorizer = Vectorizer(r=1, d=1)
+    delta = DeltaVectorizer(vectorizer)
+    random.seed(1)
+    parent = nx.disjoint_union_all(graphs)
+    for step in range(4):
+        proposals = list(lsgg.neighbors_sample(parent, 3)) + [parent]
+        assert np.allclose(delta.transform(proposals, parent).toarray(), vectorizer.transform(proposals).toarray())
+        assert any(d is not None for g, d in delta._deltas)
+        parent = proposals[0]
+
+
+def test_cached_estimator():
+    graphs = util.get_cyclegraphs()
+    relabeled = nx.convert_node_labels_to_integers(graphs[0], first_label=100)
+    assert graph_key(relabeled) == graph_key(graphs[0]) != graph_key(graphs[1])
+
+    scorer = LengthScorer()
+    cached = CachedEstimator(scorer, maxsize=2)
+    assert list(cached.decision_function([graphs[0], relabeled, graphs[1]])) == [len(graphs[0])] * 2 + [len(graphs[1])]
+    assert sum(scorer.calls) == 2 and (cached.hits, cached.misses) == (1, 2)
+    cached.decision_function([graphs[1], graphs[2]])
+    assert sum(scorer.calls) == 3 and (cached.hits, cached.misses) == (2, 3)
+    cached.decision_function([graphs[0]])  # evicted
+    assert sum(scorer.calls) == 4
+
+
+def test_cached_estimator_state():
+    # attributes are set on the estimator and the scores of other settings are not reused
+    graphs = util.get_cyclegraphs()
+    estimator = OneClassAndSizeFactor().fit(graphs)
+    lsgg = sampleutil.get_grammar(graphs)
+    sampler = sampleutil.get_sampler(lsgg, scorer=estimator, score_cache=100, n_steps=2)
+    sampler.sample_sizeconstraint(graphs[0], penalty=.1)
+    assert estimator.sizefactor == len(graphs[0]) and sampler.scorer.sizepenalty == .1
+    cached = sampler.scorer
+    first = cached.decision_function(graphs)
+    cached.sizefactor = 100
+    assert estimator.sizefactor == 100
+    assert not np.allclose(cached.decision_function(graphs), first)
+    assert np.allclose(cached.decision_function(graphs), estimator.decision_function(graphs))
+
+
+def test_estimator_pool_generator():
+    # with a pool, graphs can still be any iterable
+    graphs = util.get_cyclegraphs()
+    estimator = OneClassEstimator(n_jobs=2).fit(g for g in graphs)
+    try:
+        assert (estimator.transform(g for g in graphs) != Vectorizer().transform(graphs)).nnz == 0
+        assert np.allclose(estimator.decision_function(iter(graphs)),
+                           OneClassEstimator().fit(graphs).decision_function(graphs))
+    finally:
+        estimator.pool.close()
@@ -0,0 +1,206 @@
+"""
+microbenchmarks for the grammar hot paths.
+
+    python -m graphlearn.util.benchmark --out run.json
+    python -m graphlearn.util.benchmark --out new.json --baseline run.json
+
+every operation is timed on synthetic graphs of each kind ('molecule',
+'cyclic') and size, the best of repeat runs is recorded in seconds under
+'operation/kind/size'. compare() flags the keys that got slower than the
+baseline by more than the tolerance, the command line exits with 1 then.
+"""
+
+import argparse
+from itertools import islice
+import json
+import platform
+import random
+import sys
+import time
+import networkx as nx
+import numpy as np
+
+from graphlearn import lsgg_core_interface_pair as lcip
+from graphlearn.util import util
+
+OPERATIONS = ['graph_hash', 'get_cores', 'cip', 'substitute_core', 'fit', 'fit_parallel',
+              'neighbors', 'neighbors_sample', 'sample_step']
+
+
+###########
+# graphs
+###########
+def molecule_graph(n_atoms, rng):
+    """rings of 5 and 6 atoms with side chains, eden style labels"""
+    graph = nx.cycle_graph(6)
+    while len(graph) < n_atoms:
+        free = [n for n in graph if graph.degree(n) < 3]
+        anchor = rng.choice(free)
+        start = len(graph)
+        if rng.random() < .4:
+            size = rng.choice([5, 6])
+            graph.add_edges_from(nx.cycle_graph(range(start, start + size)).edges())
+            graph.add_edge(anchor, start)
+        else:
+            graph.add_edge(anchor, start)
+    for n in graph:
+        graph.nodes[n]['label'] = rng.choice('CCCCCNNOS')
+    for a, b in graph.edges():
+        graph[a][b]['label'] = rng.choice('1112')
+    return graph
+
+
+def cyclic_graph(n_nodes, rng):
+    """the cycle graphs of util.get_cyclegraphs, joined by single edges"""
+    motifs = util.get_cyclegraphs() + [util.test_get_circular_graph()]
+    graph = nx.Graph()
+    while len(graph) < n_nodes:
+        motif = nx.convert_node_labels_to_integers(rng.choice(motifs), first_label=len(graph))
+        anchor = rng.choice(list(graph)) if len(graph) else None
+        graph.update(motif)
+        if anchor is not None:
+            graph.add_edge(anchor, rng.choice(list(motif)), label='.')
+    return graph
+
+
+GENERATORS = {'molecule': molecule_graph, 'cyclic': cyclic_graph}
+
+
+def make_graphs(kind, size, n_graphs, seed=0):
+    rng = random.Random(seed)
+    return [GENERATORS[kind](size, rng) for i in range(n_graphs)]
+
+
+###########
+# operations, setup(graphs) -> function to time
+###########
+def _grammar(graphs, n_jobs=1):
+    from graphlearn.sample import LocalSubstitutionGraphGrammarSample
+    return LocalSubstitutionGraphGrammarSample(radii=[0, 1, 2], thickness=1,
+                                               filter_min_cip=1, filter_min_interface=1).fit(graphs, n_jobs=n_jobs)
+
+
+def _expanded(graphs):
+    exgraphs = [lcip._edge_to_vertex(g) for g in graphs]
+    for g in exgraphs:
+        lcip._add_hlabel(g)
+    return exgraphs
+
+
+def setup(operation, graphs, n_jobs=2):
+    if operation == 'graph_hash':
+        exgraphs = _expanded(graphs)
+        return lambda: [lcip.graph_hash(g) for g in exgraphs]
+    if operation == 'get_cores':
+        return lambda: [list(lcip.get_cores(g, [0, 2, 4])) for g in graphs]
+    grammar = _grammar(graphs)
+    if operation == 'cip':
+        # the fit path: cores, hashes and cips from one decomposition context per graph
+        return lambda: [list(grammar._get_cips(g)) for g in graphs]
+    if operation == 'substitute_core':
+        subs = [(g, s) for g in graphs for s in islice(grammar.substitutions_sample(g), 5)]
+        return lambda: [lcip.substitute_core(g, *s) for g, s in subs]
+    if operation == 'fit':
+        return lambda: _grammar(graphs)
+    if operation == 'fit_parallel':
+        return lambda: _grammar(graphs, n_jobs)
+    if operation == 'neighbors':
+        return lambda: [list(islice(grammar.neighbors(g), 10)) for g in graphs]
+    if operation == 'neighbors_sample':
+        return lambda: [list(grammar.neighbors_sample(g, 10)) for g in graphs]
+    if operation == 'sample_step':
+        from graphlearn.sample import Sampler
+        from graphlearn.score import OneClassEstimator
+        from graphlearn.choice import SelectMax
+        sampler = Sampler(grammar=grammar, scorer=OneClassEstimator().fit(graphs),
+                          selector=SelectMax(), transformer=util.no_transform())
+        return lambda: [sampler.sample_step(g, 0) for g in graphs]
+    raise ValueError('unknown operation %s' % operation)
+
+
+###########
+# running and comparing
+###########
+def best_time(func, repeat=3):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def run(operations=OPERATIONS, kinds=('molecule', 'cyclic'), sizes=(20, 80, 320),
+        n_graphs=10, repeat=3, n_jobs=2, seed=0):
+    """{'meta': .., 'results': {'operation/kind/size': seconds}}"""
+    results = {}
+    for kind in kinds:
+        for size in sizes:
+            graphs = make_graphs(kind, size, n_graphs, seed)
+            for operation in operations:
+                random.seed(seed)
+                np.random.seed(seed)
+                results['%s/%s/%d' % (operation, kind, size)] = best_time(setup(operation, graphs, n_jobs), repeat)
+    meta = dict(python=platform.python_version(), machine=platform.machine(), time=time.time(),
+                n_graphs=n_graphs, repeat=repeat, n_jobs=n_jobs, seed=seed)
+    return dict(meta=meta, results=results)
+
+
+def save(run_result, path):
+    with open(path, 'w') as f:
+        json.dump(run_result, f, indent=1, sort_keys=True)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(run_result, baseline, tolerance=.25):
+    """[(key, baseline seconds, seconds, ratio)] for the keys that are slower by more than tolerance"""
+    old, new = baseline['results'], run_result['results']
+    slower = []
+    for key in sorted(set(old) & set(new)):
+        ratio = new[key] / old[key] if old[key] > 0 else 1
+        if ratio > 1 + tolerance:
+            slower.append((key, old[key], new[key], ratio))
+    return slower
+
+
+def report(run_result, baseline=None):
+    old = baseline['results'] if baseline else {}
+    for key, seconds in sorted(run_result['results'].items()):
+        line = '%-40s %10.5f' % (key, seconds)
+        if key in old:
+            line += ' %10.5f %6.2fx' % (old[key], seconds / old[key] if old[key] > 0 else 1)
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--out', help='write the results to this json file')
+    parser.add_argument('--baseline', help='json file of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=.25, help='allowed slowdown, .25: 25%%')
+    parser.add_argument('--operations', nargs='+', default=OPERATIONS, choices=OPERATIONS)
+    parser.add_argument('--kinds', nargs='+', default=['molecule', 'cyclic'], choices=sorted(GENERATORS))
+    parser.add_argument('--sizes', nargs='+', type=int, default=[20, 80, 320])
+    parser.add_argument('--n_graphs', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--n_jobs', type=int, default=2)
+    args = parser.parse_args(argv)
+
+    result = run(args.operations, args.kinds, args.sizes, args.n_graphs, args.repeat, args.n_jobs)
+    baseline = load(args.baseline) if args.baseline else None
+    report(result, baseline)
+    if args.out:
+        save(result, args.out)
+    if baseline:
+        slower = compare(result, baseline, args.tolerance)
+        for key, old, new, ratio in slower:
+            print('slower: %s %.5f -> %.5f (%.2fx)' % (key, old, new, ratio))
+        return 1 if slower else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,230 @@
+"""
+vectorize proposals by patching the feature vector of their parent graph.
+
+    delta = DeltaVectorizer(Vectorizer())
+    matrix = delta.transform(proposals, parent)
+
+a proposal keeps the node ids of its parent outside of the substituted core,
+so the nodes whose attributes or adjacency differ (the seeds) are found with
+a diff. the eden features of a node are pairs of neighborhoods:
+
+    the neighborhood hash of x depends on the graph within m = max(r, d) hops
+    (and the degrees of the nodes at hop m), the features of v pair its hash
+    with the hashes of the nodes within d hops.
+
+so only the hashes of nodes within m hops of a seed and the features of nodes
+within d + m hops of a seed change. these are computed on the subgraph around
+the seeds, the raw feature counts of the parent are patched with them and then
+normalized as usual. the state of a proposal is kept, if it becomes the next
+parent it is built from its delta.
+
+graphs the shortcut does not cover (weights, nesting edges, non-discrete or
+positional vectorizers) are vectorized in full.
+"""
+
+from collections import defaultdict
+from eden.graph import _edge_to_vertex_transform, _label_preprocessing
+
+
+class _State(object):
+    """a vectorized graph: node hashes, per node feature counts and their sum"""
+    __slots__ = ('graph', 'hashes', 'contributions', 'counts')
+
+    def __init__(self, graph, hashes, contributions, counts):
+        self.graph = graph
+        self.hashes = hashes
+        self.contributions = contributions
+        self.counts = counts
+
+
+class _Delta(object):
+    """what a proposal changes in the state of its parent"""
+    __slots__ = ('graph', 'removed', 'hashes', 'contributions')
+
+    def __init__(self, graph, removed, hashes, contributions):
+        self.graph = graph
+        self.removed = removed
+        self.hashes = hashes
+        self.contributions = contributions
+
+
+class DeltaVectorizer(object):
+
+    def __init__(self, vectorizer):
+        self.vectorizer = vectorizer
+        self._parent = None
+        # deltas of the proposals of the current parent, None: vectorized in full
+        self._deltas = []
+
+    def transform(self, graphs, parent):
+        """the sparse matrix of graphs, graphs are proposals made from parent"""
+        vec = self.vectorizer
+        state = self._parent_state(parent)
+        if state is None:
+            return vec.transform(graphs)
+        rows = []
+        for graph in graphs:
+            delta = self._delta(state, graph)
+            if delta is None:
+                rows.append(vec._transform(graph))
+            else:
+                counts = _patch(state.counts, *self._changes(state, delta))
+                rows.append(vec._normalization(_ordered(counts, graph, state, delta)))
+            self._deltas.append((graph, delta))
+        return vec._convert_dict_to_sparse_matrix(rows)
+
+    def _supported(self, graph, nodes=None):
+        vec = self.vectorizer
+        if not vec.discrete or vec.positional:
+            return False
+        nodes = graph.nodes() if nodes is None else nodes
+        for n in nodes:
+            if graph.nodes[n].get(vec.key_weight, False):
+                return False
+            for attr in graph.adj[n].values():
+                if attr.get(vec.key_weight, False) or attr.get(vec.key_nesting, False):
+                    return False
+        return True
+
+    def _parent_state(self, parent):
+        if self._parent is not None and self._parent.graph is parent:
+            return self._parent
+        # the parent is usually one of the last proposals (or a copy of it)
+        deltas = self._deltas
+        found = next((d for g, d in deltas if g is parent), False)
+        if found is False:
+            found = next((d for g, d in deltas if _same(g, parent)), False)
+        self._deltas = []
+        if found is not False and found is not None:
+            self._parent = self._apply(self._parent, found, parent)
+        elif self._supported(parent):
+            self._parent = self._state(parent)
+        else:
+            self._parent = None
+        return self._parent
+
+    def _state(self, graph):
+        exgraph = self.vectorizer._graph_preprocessing(graph)
+        hashes, contributions = {}, {}
+        for n, d in exgraph.nodes(data=True):
+            if d.get('node', False):
+                hashes[n] = d['neigh_graph_hash']
+                contributions[n] = self._contribution(exgraph, n)
+        return _State(graph, hashes, contributions, _patch({}, [], contributions.values()))
+
+    def _contribution(self, exgraph, n):
+        features = defaultdict(lambda: defaultdict(float))
+        self.vectorizer._transform_vertex(exgraph, n, features)
+        return {key: dict(counts) for key, counts in features.items()}
+
+    def _delta(self, state, graph):
+        """the _Delta of graph or None if it has to be vectorized in full"""
+        vec = self.vectorizer
+        parent = state.graph
+        removed = [n for n in parent if n not in graph]
+        seeds = [n for n in graph if n not in parent or _changed(graph, parent, n)]
+        if not self._supported(graph, seeds):
+            return None
+        m = max(vec.r, vec.d)
+        dist = _distances(graph, seeds, max(2 * m + 1, 2 * vec.d + m))
+        if len(dist) == len(graph):
+            return None
+        hashes, contributions = {}, {}
+        if dist:
+            sub = _edge_to_vertex_transform(graph.subgraph(dist))
+            _label_preprocessing(sub, key_label=vec.key_label, bitmask=vec.bitmask)
+            for n, k in dist.items():
+                if k <= m:
+                    vec._single_vertex_breadth_first_visit(sub, n, 2 * m)
+                    vec._compute_neighborhood_graph_hash(n, sub)
+                    hashes[n] = sub.nodes[n]['neigh_graph_hash']
+                else:
+                    sub.nodes[n]['neigh_graph_hash'] = state.hashes[n]
+            for n, k in dist.items():
+                if k <= vec.d + m:
+                    if k > m:
+                        vec._single_vertex_breadth_first_visit(sub, n, 2 * vec.d)
+                    contributions[n] = self._contribution(sub, n)
+        return _Delta(graph, removed, hashes, contributions)
+
+    def _changes(self, state, delta):
+        """the contributions delta takes away from and adds to the state"""
+        old = [state.contributions[n] for n in delta.removed]
+        old += [state.contributions[n] for n in delta.contributions if n in state.contributions]
+        return old, delta.contributions.values()
+
+    def _apply(self, state, delta, graph):
+        hashes, contributions = dict(state.hashes), dict(state.contributions)
+        for n in delta.removed:
+            del hashes[n], contributions[n]
+        hashes.update(delta.hashes)
+        contributions.update(delta.contributions)
+        return _State(graph, hashes, contributions, _patch(state.counts, *self._changes(state, delta)))
+
+
+def _patch(counts, old, new):
+    """copy of the {(r,d): {feature: count}} counts without old plus new"""
+    counts = {key: dict(features) for key, features in counts.items()}
+    for contribution, sign in [(c, -1) for c in old] + [(c, 1) for c in new]:
+        for key, features in contribution.items():
+            total = counts.setdefault(key, {})
+            for feature, count in features.items():
+                total[feature] = total.get(feature, 0) + sign * count
+    # features that are gone must not reach the normalization
+    for key in list(counts):
+        counts[key] = {f: c for f, c in counts[key].items() if c != 0}
+        if not counts[key]:
+            del counts[key]
+    return counts
+
+
+def _ordered(counts, graph, state, delta):
+    """
+    counts with the (r,d) keys in the order eden's transform meets them.
+    _normalization lets a feature overwrite the same feature of an earlier key,
+    so the order matters. the first nodes usually have all the keys.
+    """
+    ordered = {}
+    for n in graph:
+        contribution = delta.contributions[n] if n in delta.contributions else state.contributions[n]
+        for key in contribution:
+            if key in counts and key not in ordered:
+                ordered[key] = counts[key]
+        if len(ordered) == len(counts):
+            break
+    return ordered
+
+
+def _distances(graph, seeds, radius):
+    """{node: hops to the nearest seed} for the nodes within radius"""
+    dist = dict.fromkeys(seeds, 0)
+    frontier = list(dist)
+    for k in range(1, radius + 1):
+        frontier = [m for n in frontier for m in graph.adj[n] if m not in dist]
+        for m in frontier:
+            dist[m] = k
+        frontier = list(set(frontier))
+        if not frontier:
+            break
+    return dist
+
+
+def _changed(graph, parent, n):
+    """the attributes or edges of n differ, eden's node/edge flags aside"""
+    # the plain dicts, comparing the networkx views is much slower
+    node, pnode = graph._node[n], parent._node[n]
+    if node != pnode and _strip(node) != _strip(pnode):
+        return True
+    adj, padj = graph._adj[n], parent._adj[n]
+    if adj == padj:
+        return False
+    return adj.keys() != padj.keys() or any(_strip(adj[m]) != _strip(padj[m]) for m in adj)
+
+
+def _strip(attr):
+    # graphs that went through the edge to vertex transform and back keep these
+    return {k: v for k, v in attr.items() if k not in ('node', 'edge')}
+
+
+def _same(a, b):
+    return len(a) == len(b) and not any(n not in b or _changed(a, b, n) for n in a)
@@ -0,0 +1,124 @@
+"""
+binary grammar files.
+
+    save(grammar, path)
+    grammar = load(path, max_interfaces=1000)
+
+layout (all integers int64, little endian):
+
+    magic | number of interfaces | length of head
+    index: (interface_hash, offset, length) per interface, sorted by hash
+    head: the pickled grammar without its productions
+    blobs: the pickled {core_hash: FrozenCIP} of every interface
+
+the FrozenCIPs keep their graphs as index arrays, so a blob decodes without
+building networkx graphs. load maps the file into memory and reads only the
+head and the index, an interface is decoded when it is first looked up.
+"""
+
+from collections import OrderedDict
+from collections.abc import Mapping
+import mmap
+import pickle
+import numpy as np
+
+MAGIC = b'graphlearn-gram'
+_HEADER = 32  # magic padded to 16 bytes, 2 int64
+_DTYPE = np.dtype('<i8')
+
+
+def save(grammar, path):
+    """write the productions of a fitted grammar to path"""
+    head = pickle.dumps(grammar._empty_copy(), protocol=pickle.HIGHEST_PROTOCOL)
+    interfaces = sorted(grammar.productions.keys())
+    index = np.zeros((len(interfaces), 3), dtype=_DTYPE)
+    offset = _HEADER + index.nbytes + len(head)
+    blobs = []
+    for i, interface in enumerate(interfaces):
+        blob = pickle.dumps(dict(grammar.productions[interface]), protocol=pickle.HIGHEST_PROTOCOL)
+        index[i] = interface, offset, len(blob)
+        offset += len(blob)
+        blobs.append(blob)
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC.ljust(16, b'\0'))
+        f.write(np.array([len(interfaces), len(head)], dtype=_DTYPE).tobytes())
+        f.write(index.tobytes())
+        f.write(head)
+        for blob in blobs:
+            f.write(blob)
+
+
+def load(path, max_interfaces=None):
+    """
+    the grammar saved in path, its productions are a read only LazyProductions.
+    it can sample, fit and partial_fit raise a ValueError
+
+    max_interfaces: keep at most this many decoded interfaces in memory
+    """
+    productions = LazyProductions(path, max_interfaces)
+    grammar = pickle.loads(productions._head())
+    grammar.productions = productions
+    grammar._index_productions()
+    return grammar
+
+
+class LazyProductions(Mapping):
+    """
+    {interface_hash: {core_hash: cip}} backed by a grammar file.
+
+    interfaces are decoded on access, the max_interfaces most recently used
+    ones are cached (all of them if max_interfaces is None).
+    """
+
+    def __init__(self, path, max_interfaces=None):
+        self.path = path
+        self.max_interfaces = max_interfaces
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:16].rstrip(b'\0') != MAGIC:
+            raise ValueError('%s is not a grammar file' % path)
+        self._n, self._headlen = np.frombuffer(self._map, dtype=_DTYPE, count=2, offset=16).tolist()
+        self._index = np.frombuffer(self._map, dtype=_DTYPE, count=3 * self._n, offset=_HEADER).reshape(-1, 3)
+        self._cache = OrderedDict()
+
+    def _head(self):
+        start = _HEADER + self._index.nbytes
+        return self._map[start:start + self._headlen]
+
+    def _find(self, interface):
+        """position of interface in the index or -1"""
+        if not isinstance(interface, (int, np.integer)) or not -2 ** 63 <= interface < 2 ** 63:
+            return -1
+        i = int(np.searchsorted(self._index[:, 0], interface))
+        if i < self._n and self._index[i, 0] == interface:
+            return i
+        return -1
+
+    def __getitem__(self, interface):
+        cips = self._cache.get(interface)
+        if cips is not None:
+            self._cache.move_to_end(interface)
+            return cips
+        i = self._find(interface)
+        if i < 0:
+            raise KeyError(interface)
+        offset, length = self._index[i, 1:].tolist()
+        cips = pickle.loads(self._map[offset:offset + length])
+        self._cache[interface] = cips
+        if self.max_interfaces is not None and len(self._cache) > self.max_interfaces:
+            self._cache.popitem(last=False)
+        return cips
+
+    def __contains__(self, interface):
+        return interface in self._cache or self._find(interface) >= 0
+
+    def __iter__(self):
+        return iter(self._index[:, 0].tolist())
+
+    def __len__(self):
+        return self._n
+
+    def __reduce__(self):
+        # the map can not be pickled, the file is mapped again
+        return LazyProductions, (self.path, self.max_interfaces)
@@ -0,0 +1,211 @@
+"""
+batched graph hashing.
+
+the graph is turned into a CSR array view once, then the radius-bounded
+neighborhoods of all nodes are expanded together, one numpy pass per
+distance. labels are folded into the neighborhoods with a commutative
+(multiset) hash, so no python tuples need to be sorted and hashed.
+
+graph_hash is the one entry point, lsgg_core_interface_pair.graph_hash calls
+it. engine 'numpy' hashes as above, but graphs below SMALL_GRAPH nodes with
+the 'reference' engine, the original per-node bfs and tuple hashing. the
+values of the engines differ, but two graphs get the same hash under one
+engine if (and, collisions aside, only if) they get the same hash under the
+other. isomorphic graphs have the same size, so the switch at SMALL_GRAPH
+does not split them.
+
+labels go through stable_hash, so the hashes do not depend on PYTHONHASHSEED
+and are the same in every process and run.
+"""
+
+import hashlib
+import numpy as np
+import networkx as nx
+
+NEIGHBORHOOD_RADIUS = 5
+
+_GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+_ISOLATE_SALT = np.uint64(0x2545F4914F6CDD1D)
+_DENSE_LIMIT = 2 ** 22
+# below this many nodes the numpy overhead dominates, the reference engine is faster.
+# measured on expanded molecule cores: 12-20 nodes numpy 0.54s, reference 0.27s;
+# 20-40 nodes numpy 0.34s, reference 0.28s; numpy only wins from about 40 nodes
+SMALL_GRAPH = 40
+
+
+def _mix(x):
+    """splitmix64 finalizer, x is an uint64 array (or scalar)"""
+    with np.errstate(over='ignore'):
+        x = x + _GOLDEN
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return x ^ (x >> np.uint64(31))
+
+
+def _to_int(h):
+    """uint64 -> python int in the same (signed) range as hash()"""
+    return int(np.array([h], dtype=np.uint64).view(np.int64)[0])
+
+
+def stable_hash(value):
+    """
+    hash() that is the same in every process: numbers keep their hash(), which
+    does not depend on PYTHONHASHSEED, everything else (strings, tuples) is
+    hashed by the 64 bit blake2b digest of its repr, numpy scalars in it are
+    taken as the python scalars they equal.
+    """
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        return hash(value)
+    digest = hashlib.blake2b(repr(_plain(value)).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little', signed=True)
+
+
+def _plain(value):
+    """numpy scalars as python scalars, also in tuples and lists. numpy 2 reprs
+    np.int64(1) as 'np.int64(1)', so (np.int64(1), 2) would not hash as (1, 2)"""
+    if isinstance(value, np.generic):
+        return value.item()
+    if type(value) in (tuple, list):
+        return type(value)(_plain(v) for v in value)
+    return value
+
+
+def _label_hashes(graph, nodes, get_node_label):
+    labels = [stable_hash(get_node_label(n, graph.nodes[n])) for n in nodes]
+    return np.array(labels, dtype=np.int64).view(np.uint64)
+
+
+def csr(graph):
+    """
+    array view of a graph
+
+    RETURNS:
+    nodes: list of node ids, position in the list is the node index
+    edges: (m,2) array of node indices
+    indptr, indices: CSR adjacency (both directions)
+    """
+    nodes = list(graph.nodes())
+    index = {n: i for i, n in enumerate(nodes)}
+    edges = np.array([(index[a], index[b]) for a, b in graph.edges()], dtype=np.int64).reshape(-1, 2)
+    src = np.concatenate((edges[:, 0], edges[:, 1]))
+    dst = np.concatenate((edges[:, 1], edges[:, 0]))
+    order = np.argsort(src, kind='stable')
+    indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=len(nodes)), out=indptr[1:])
+    return nodes, edges, indptr, dst[order]
+
+
+def neighborhoods(indptr, indices, radius):
+    """
+    bounded bfs from every node at once.
+
+    RETURNS: src, node, dist arrays; node is at distance dist from src
+    (every pair with dist <= radius appears exactly once)
+    """
+    n = len(indptr) - 1
+    fsrc = fnode = np.arange(n, dtype=np.int64)
+    # small graphs: a dense n*n table of visited pairs, else a sorted key array
+    dense = n * n <= _DENSE_LIMIT
+    seen = np.zeros(n * n, dtype=bool) if dense else fsrc * n + fnode
+    if dense:
+        seen[fsrc * n + fnode] = True
+    src, node, dist = [fsrc], [fnode], [np.zeros(n, dtype=np.int64)]
+    for d in range(1, radius + 1):
+        deg = indptr[fnode + 1] - indptr[fnode]
+        total = deg.sum()
+        if total == 0:
+            break
+        # positions of all neighbors of all frontier nodes
+        start = np.repeat(indptr[fnode] - np.cumsum(deg) + deg, deg)
+        nsrc = np.repeat(fsrc, deg)
+        nnode = indices[start + np.arange(total)]
+        keys = nsrc * n + nnode
+        if dense:
+            keys = np.unique(keys[~seen[keys]])
+            seen[keys] = True
+        else:
+            keys = np.unique(keys)
+            keys = keys[~np.isin(keys, seen, assume_unique=True)]
+            seen = np.concatenate((seen, keys))
+        if len(keys) == 0:
+            break
+        fsrc, fnode = keys // n, keys % n
+        src.append(fsrc)
+        node.append(fnode)
+        dist.append(np.full(len(keys), d, dtype=np.int64))
+    return np.concatenate(src), np.concatenate(node), np.concatenate(dist)
+
+
+def _node_hashes(graph, get_node_label, radius):
+    nodes, edges, indptr, indices = csr(graph)
+    labels = _label_hashes(graph, nodes, get_node_label)
+    src, node, dist = neighborhoods(indptr, indices, radius)
+    acc = np.zeros(len(nodes), dtype=np.uint64)
+    np.add.at(acc, src, _mix(labels[node] + dist.astype(np.uint64) * _GOLDEN))
+    return nodes, edges, indptr, labels, _mix(acc)
+
+
+def canonical_order(graph, get_node_label=lambda id, node: node['hlabel'], radius=NEIGHBORHOOD_RADIUS):
+    """
+    the node indices (see csr) sorted by the hash of their neighborhood.
+    a tie is broken by giving its first node a label of its own and hashing
+    again, so nodes that are symmetric do not prevent a canonical order.
+
+    RETURNS: order, the hashes in that order
+    """
+    nodes, edges, indptr, indices = csr(graph)
+    labels = _label_hashes(graph, nodes, get_node_label)
+    src, node, dist = neighborhoods(indptr, indices, radius)
+    dist = dist.astype(np.uint64) * _GOLDEN
+    for i in range(len(nodes) + 1):
+        acc = np.zeros(len(nodes), dtype=np.uint64)
+        np.add.at(acc, src, _mix(labels[node] + dist))
+        keys = _mix(acc)
+        order = np.argsort(keys, kind='stable')
+        ties = np.flatnonzero(keys[order][1:] == keys[order][:-1])
+        if len(ties) == 0:
+            break
+        labels[order[ties[0]]] = _mix(labels[order[ties[0]]] ^ _ISOLATE_SALT)
+    return order, keys[order]
+
+
+def graph_hash(graph, get_node_label=lambda id, node: node['hlabel'], radius=NEIGHBORHOOD_RADIUS, engine='numpy'):
+    """
+    calculate a hash of a graph
+    engine: 'numpy' or 'reference', see above
+    """
+    if engine == 'reference' or len(graph) < SMALL_GRAPH:
+        return _graph_hash_reference(graph, get_node_label, radius)
+    nodes, edges, indptr, labels, nh = _node_hashes(graph, get_node_label, radius)
+
+    a, b = nh[edges[:, 0]], nh[edges[:, 1]]
+    edge_hashes = _mix(_mix(np.minimum(a, b)) ^ np.maximum(a, b))
+
+    isolates = np.flatnonzero(indptr[1:] == indptr[:-1])
+    isolate_hashes = _mix(labels[isolates] ^ _ISOLATE_SALT)
+
+    with np.errstate(over='ignore'):
+        return _to_int(_mix(edge_hashes.sum(dtype=np.uint64) + isolate_hashes.sum(dtype=np.uint64)))
+
+
+def _graph_hash_reference(graph, get_node_label, radius):
+    labels = {n: stable_hash(get_node_label(n, d)) for n, d in graph.nodes(data=True)}
+    node_neighborhood_hashes = {n: _graph_hash_neighborhood(graph, n, labels, radius) for n in graph.nodes()}
+
+    edge_hash = lambda a, b: hash((min(a, b), max(a, b)))
+    l = [edge_hash(node_neighborhood_hashes[a],
+                   node_neighborhood_hashes[b]) for (a, b) in graph.edges()]
+    l.sort()
+
+    isolates = [n for (n, d) in graph.degree if d == 0]
+    z = [labels[node_id] for node_id in isolates]
+    z.sort()
+    return hash(tuple(l + z))
+
+
+def _graph_hash_neighborhood(graph, node, labels, radius):
+    """labels: {node: stable hash of its label}"""
+    d = nx.single_source_shortest_path_length(graph, node, radius)
+    l = [hash((labels[nid], dis)) for nid, dis in d.items()]
+    l.sort()
+    return hash(tuple(l))
@@ -1,11 +1,179 @@
 
-
 import multiprocessing as mp
-def mpmap(func, iterable, chunksize=10, poolsize=2):
-    """pmap."""
-    pool = mp.Pool(poolsize)
-    result = pool.map(func, iterable, chunksize=chunksize)
-    pool.close()
-    pool.join()
-    return list(result)
+from itertools import islice
+import functools
+import os
+import pickle
+import tempfile
+import weakref
+
+# map() puts no more than this many bytes of (pickled) items into one task
+CHUNK_BYTES = 2 ** 20
+
+
+class WorkerPool(object):
+    """
+    processes that are started once and reused for many maps.
+
+        pool = WorkerPool(4, vectorizer=vectorizer)
+        pool.map('vectorizer.transform', batches)
+        pool.map(len, graphs)
+        pool.close()
+
+    the keyword arguments are resident: the workers get them when they start,
+    func may name one of them (or one of its methods) instead of being a
+    callable, so the object is not pickled with every task.
+
+    a pool can be shared by many callers, map and imap then take the objects
+    of one call as resident: {name: object}. they are pickled to a file once,
+    every worker loads them once per call.
+
+        pool.map('grammar.fit', batches, resident={'grammar': grammar})
+    """
+
+    def __init__(self, poolsize=2, **resident):
+        self.poolsize = poolsize
+        self.resident = resident
+        self._pool = mp.Pool(poolsize, initializer=_init, initargs=(resident,))
+        # pools that are never closed are stopped before the interpreter goes down
+        self._terminate = weakref.finalize(self, self._pool.terminate)
+
+    def map(self, func, iterable, chunksize=None, resident=None):
+        """[func(item) for item in iterable], chunksize None: see chunksize()"""
+        items = list(iterable)
+        chunksize = chunksize or self.chunksize(items)
+        path = _dump(resident)
+        try:
+            return self._pool.map(self._func(func, resident, path), items, chunksize=chunksize)
+        finally:
+            _remove(path)
+
+    def imap(self, func, iterable, chunksize=1, buffersize=None, resident=None):
+        """
+        streaming map, results are yielded in the order they are finished.
+
+        the iterable is read buffersize items at a time, the next buffer is
+        submitted while the results of the current one are collected.
+        so no more than 2 buffers of items are in flight, no matter how
+        long the iterable is.
+        """
+        path = _dump(resident)
+        # the buffers that were submitted and not yet collected
+        inflight = []
+        try:
+            func = self._func(func, resident, path)
+            buffersize = buffersize or chunksize * self.poolsize * 4
+            iterable = iter(iterable)
+            pending = self._pool.imap_unordered(func, list(islice(iterable, buffersize)), chunksize=chunksize)
+            inflight.append(pending)
+            while pending is not None:
+                batch = list(islice(iterable, buffersize))
+                following = self._pool.imap_unordered(func, batch, chunksize=chunksize) if batch else None
+                if following is not None:
+                    inflight.append(following)
+                for result in pending:
+                    yield result
+                inflight.remove(pending)
+                pending = following
+        finally:
+            # a consumer that stops early leaves tasks in the queue, they may
+            # still load the resident file. a closed or terminated pool has none
+            if path is not None and self._terminate.alive:
+                for results in inflight:
+                    _wait(results)
+            _remove(path)
+
+    def chunksize(self, items):
+        """items per task: about 4 tasks per worker, no more than CHUNK_BYTES per task"""
+        if not items:
+            return 1
+        itemsize = len(pickle.dumps(items[0], protocol=pickle.HIGHEST_PROTOCOL))
+        balanced = -(-len(items) // (4 * self.poolsize))
+        return max(1, min(balanced, CHUNK_BYTES // max(itemsize, 1)))
+
+    def close(self):
+        """the workers finish the tasks they have and exit"""
+        self._terminate.detach()
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self):
+        """stop the workers now, their tasks are lost"""
+        self._terminate()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+    def __getstate__(self):
+        raise TypeError('a WorkerPool belongs to the process that started it')
+
+    def _func(self, func, resident=None, path=None):
+        if isinstance(func, str):
+            name = func.partition('.')[0]
+            if name not in self.resident and name not in (resident or {}):
+                raise KeyError('%s is not resident' % func)
+            return functools.partial(_call_resident, func, path)
+        return func
+
+
+_resident = {}
+# the resident objects of the current call: (path, {name: object})
+_call = [None, {}]
+
+
+def _init(resident):
+    _resident.clear()
+    _resident.update(resident)
+
+
+def _call_resident(name, path, item):
+    name, _, method = name.partition('.')
+    if path is not None and _call[0] != path:
+        with open(path, 'rb') as f:
+            _call[:] = path, pickle.load(f)
+    func = _call[1][name] if path is not None and name in _call[1] else _resident[name]
+    if method:
+        func = getattr(func, method)
+    return func(item)
+
+
+def _dump(resident):
+    """the path of a file with the pickled resident objects of a call, None if there are none"""
+    if not resident:
+        return None
+    fd, path = tempfile.mkstemp(prefix='workerpool-')
+    with os.fdopen(fd, 'wb') as f:
+        pickle.dump(resident, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return path
+
+
+def _wait(results):
+    """wait until all tasks of an imap are done, their results and errors are dropped"""
+    while True:
+        try:
+            next(results)
+        except StopIteration:
+            return
+        except Exception:
+            pass
+
+
+def _remove(path):
+    if path is not None and os.path.exists(path):
+        os.remove(path)
+
 
+def chunks(iterable, size):
+    """lists of size items (the last one may be shorter)"""
+    iterable = iter(iterable)
+    chunk = list(islice(iterable, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterable, size))
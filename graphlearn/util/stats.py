@@ -0,0 +1,80 @@
+"""
+counters and timers of a grammar.
+
+    stats = grammar.collect_stats()
+    grammar.fit(graphs)
+    print(stats.report())
+    grammar.stats = None  # stop counting
+
+counts: events, e.g. cores, cips, filtered_cips, failed_substitutions
+seconds, calls: time spent in and number of calls of each phase
+    (decompose, hash, cip, congruent, substitute, filter)
+interfaces: per interface hash the time spent on its cips and substitutions,
+    the congruent lookups and their fan-out, substitutions, failures and
+    isomorphism (vf2) calls
+"""
+
+from collections import Counter, defaultdict
+
+
+class GrammarStats(object):
+
+    def __init__(self):
+        self.counts = Counter()
+        self.seconds = Counter()
+        self.calls = Counter()
+        self.interfaces = defaultdict(Counter)
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    def add_time(self, phase, seconds, interface=None):
+        self.seconds[phase] += seconds
+        self.calls[phase] += 1
+        if interface is not None:
+            self.interfaces[interface]['seconds'] += seconds
+
+    def lookup(self, interface, fanout):
+        """a congruent cip lookup that found fanout cips"""
+        self.counts['congruent_lookups'] += 1
+        self.counts['congruent_cips'] += fanout
+        stats = self.interfaces[interface]
+        stats['lookups'] += 1
+        stats['fanout'] += fanout
+
+    def substitution(self, interface, seconds, ok, isomorphisms=0):
+        self.add_time('substitute', seconds, interface)
+        self.counts['isomorphism_calls'] += isomorphisms
+        stats = self.interfaces[interface]
+        stats['substitutions'] += 1
+        stats['isomorphism_calls'] += isomorphisms
+        if not ok:
+            self.counts['failed_substitutions'] += 1
+            stats['failures'] += 1
+
+    def merge(self, other):
+        """add the numbers of other, e.g. of a grammar in another process"""
+        self.counts.update(other.counts)
+        self.seconds.update(other.seconds)
+        self.calls.update(other.calls)
+        for interface, stats in other.interfaces.items():
+            self.interfaces[interface].update(stats)
+        return self
+
+    def costly_interfaces(self, top=10):
+        """[(interface hash, its stats)] of the interfaces that took the most time"""
+        ranked = sorted(self.interfaces.items(), key=lambda item: item[1]['seconds'], reverse=True)
+        return ranked[:top]
+
+    def report(self, top=10):
+        lines = ['%-24s %d' % (name, n) for name, n in sorted(self.counts.items())]
+        lines += ['%-24s %9.4fs %8d calls' % (phase, self.seconds[phase], self.calls[phase])
+                  for phase, s in self.seconds.most_common()]
+        lines.append('%-21s %10s %8s %7s %6s %9s %5s' % ('interface', 'seconds', 'lookups', 'fanout',
+                                                        'subst', 'failures', 'vf2'))
+        for interface, stats in self.costly_interfaces(top):
+            fanout = stats['fanout'] / stats['lookups'] if stats['lookups'] else 0
+            lines.append('%-21d %10.4f %8d %7.1f %6d %9d %5d' % (
+                interface, stats['seconds'], stats['lookups'], fanout, stats['substitutions'],
+                stats['failures'], stats['isomorphism_calls']))
+        return '\n'.join(lines)
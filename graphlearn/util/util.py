@@ -24,6 +24,21 @@ def _extract_grammar_stats(grammar):
 
 
 
+class no_transform(object):
+    """transformer for graphs that are sampled as they are"""
+    def encode_single(self, thing):
+        return thing
+
+    def encode(self, thing):
+        for e in thing:
+            yield e
+    def _decode_single(self,thing):
+        return thing
+    def decode(self, thing):
+        for e in thing:
+            yield e
+
+
 def _edenize_for_testing(g):
     for n in g.nodes():
         g.nodes[n]['label'] = str(n)